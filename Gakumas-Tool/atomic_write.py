@@ -0,0 +1,50 @@
+import json
+import os
+import tempfile
+from typing import Callable, IO
+
+# Files are written to a temporary file in the same directory first,
+# then moved over the old file, so an interrupted run or another process
+# never sees a partially written file
+
+# The temporary files are only readable by their owner, so the files
+# are given the mode a new file would have, or the mode of the old file
+# The umask can only be read by setting it, so it's read once on import,
+# before any threads are started
+file_umask = os.umask(0)
+os.umask(file_umask)
+
+
+def get_file_mode(file_path: str) -> int:
+    try:
+        return os.stat(file_path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~file_umask
+
+
+def write_file_atomically(
+    file_path: str, write: Callable[[IO], None], binary: bool = False
+):
+    # Calls write with the temporary file, which is removed if anything fails
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path) or ".", suffix=".tmp"
+    )
+    try:
+        if binary:
+            file = os.fdopen(file_descriptor, "wb")
+        else:
+            file = os.fdopen(file_descriptor, "w", encoding="utf-8")
+        with file:
+            write(file)
+        os.chmod(temp_path, get_file_mode(file_path))
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def write_json_atomically(file_path: str, data, **json_options):
+    write_file_atomically(file_path, lambda file: json.dump(data, file, **json_options))
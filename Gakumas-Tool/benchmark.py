@@ -0,0 +1,627 @@
+import argparse
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from functools import partial
+from bulk_extract import extract_directory
+from commu_parser import CommuGroup, ParsingString, parse_animation_curve_json_data
+from data_types import RawLine, TranslationLine
+from extract_lines import create_dialogue_rows, create_raw_data_rows, extract_lines
+from file_formats import file_formats, get_tl_lines
+from inject_translations import (
+    inject_spreadsheet,
+    parse_commu_for_injection,
+    write_injected_lines,
+)
+from main import (
+    iter_file_jobs,
+    merge_extracted_lines,
+    parse_commu_to_extract,
+    write_extracted_lines,
+)
+from parse_cache import ParseCache
+from spreadsheet import (
+    get_tl_lines_from_spreadsheet,
+    spreadsheet_codecs,
+    write_tl_lines_to_spreadsheet,
+)
+from save_to_excel import (
+    align_merge_lines,
+    merge_lines,
+    to_raw_line,
+    to_translation_line,
+)
+
+# Runs offline benchmarks of the parser and the extract/inject pipeline
+# on synthetic commu lines, e.g.
+#   python benchmark.py --lines 5000 --curve-keys 400
+#   python benchmark.py parse str
+
+speaker_names = ["咲季", "手毬", "ことね", "{user}", "広", "ボイストレーナー"]
+dialogue_texts = [
+    "ほら、行くよ",
+    "プロデューサー、\\n今日もよろしくお願いします",
+    "……はい",
+    "わたしが一番なんだから！",
+    "どうしてそんなことを言うの？\\nわからない",
+]
+choice_texts = ["はい", "いいえ", "もう少し考える", "任せて"]
+
+
+def to_commu_json(data) -> str:
+    # Commu files escape the braces of embedded json
+    json_string = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    return json_string.replace("{", "\\{").replace("}", "\\}")
+
+
+def generate_clip(rng: random.Random):
+    return to_commu_json(
+        {
+            "_startTime": round(rng.uniform(0, 120), 4),
+            "_duration": round(rng.uniform(0.5, 5), 4),
+            "_clipIn": 0.0,
+            "_easeInDuration": 0.0,
+            "_easeOutDuration": 0.0,
+            "_blendInDuration": -1.0,
+            "_blendOutDuration": -1.0,
+            "_mixInEaseType": 1,
+            "_mixOutEaseType": 1,
+            "_timeScale": 1.0,
+        }
+    )
+
+
+def generate_animation_curve(rng: random.Random, key_count: int):
+    keys = [
+        {
+            "time": round(index / 30, 4),
+            "value": round(rng.uniform(-5, 5), 6),
+            "inTangent": 0.0,
+            "outTangent": 0.0,
+            "inWeight": 0.0,
+            "outWeight": 0.0,
+            "weightedMode": 0,
+            "tangentMode": 0,
+        }
+        for index in range(key_count)
+    ]
+    return "AnimationCurve::" + to_commu_json(
+        {"keys": keys, "preWrapMode": 8, "postWrapMode": 8}
+    )
+
+
+def generate_message(rng: random.Random, curve_key_count: int):
+    name = rng.choice(speaker_names)
+    text = rng.choice(dialogue_texts)
+    return f"[message text={text} name={name} clip={generate_clip(rng)}]"
+
+
+def generate_choicegroup(rng: random.Random, curve_key_count: int):
+    choices = " ".join(
+        f"choices=[choice text={choice_text}]"
+        for choice_text in rng.sample(choice_texts, rng.randint(2, 3))
+    )
+    return f"[choicegroup {choices} clip={generate_clip(rng)}]"
+
+
+def generate_narration(rng: random.Random, curve_key_count: int):
+    text = rng.choice(dialogue_texts)
+    return f"[narration text={text} clip={generate_clip(rng)}]"
+
+
+def generate_camera(rng: random.Random, curve_key_count: int):
+    curves = " ".join(
+        f"{axis}={generate_animation_curve(rng, curve_key_count)}"
+        for axis in ("positionx", "positiony", "positionz")
+    )
+    return f"[camera id=cam{rng.randint(1, 4)} {curves} clip={generate_clip(rng)}]"
+
+
+def generate_actor(rng: random.Random, curve_key_count: int):
+    return (
+        f"[actor id=actor{rng.randint(1, 6)} "
+        + f"motion=[actormotion id=motion{rng.randint(1, 30)} clip={generate_clip(rng)}] "
+        + f"clip={generate_clip(rng)}]"
+    )
+
+
+# Line generators, and how often they show up in a commu
+line_generators = [
+    (generate_message, 10),
+    (generate_narration, 3),
+    (generate_choicegroup, 1),
+    (generate_camera, 3),
+    (generate_actor, 4),
+]
+
+
+def generate_commu_lines(line_count: int, curve_key_count: int, seed: int = 0):
+    rng = random.Random(seed)
+    generators = [generator for generator, _ in line_generators]
+    weights = [weight for _, weight in line_generators]
+    return [
+        rng.choices(generators, weights)[0](rng, curve_key_count)
+        for _ in range(line_count)
+    ]
+
+
+def write_commu_corpus(
+    directory: str, file_count: int, line_count: int, curve_key_count: int
+):
+    # Writes adv_*.txt files that can be used with the extract
+    # and inject subcommands of main.py
+    os.makedirs(directory, exist_ok=True)
+    for index in range(file_count):
+        lines = generate_commu_lines(line_count, curve_key_count, seed=index)
+        file_path = os.path.join(directory, f"adv_bench_{index:04}.txt")
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines))
+            file.write("\n")
+
+
+def time_best(function, repeat: int):
+    # Returns the fastest of several runs of the function
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time
+
+
+def print_result(name: str, count: int, unit: str, seconds: float):
+    print(
+        f"{name:<32} {count / seconds:>14,.0f} {unit}/s"
+        + f" ({seconds * 1000:.2f} ms for {count:,} {unit})"
+    )
+
+
+def create_translated_lines(groups: list[CommuGroup]):
+    return [
+        TranslationLine(
+            group_type=raw_line.group_type,
+            name=raw_line.name,
+            translated_name=raw_line.name + " (TL)",
+            text=raw_line.text,
+            translated_text=raw_line.text + " (TL)",
+        )
+        for group in groups
+        for raw_line in create_raw_data_rows(group)
+    ]
+
+
+def benchmark_parse(lines: list[str], repeat: int):
+    seconds = time_best(
+        lambda: [CommuGroup.from_commu_line(line) for line in lines], repeat
+    )
+    print_result("CommuGroup.from_commu_line", len(lines), "lines", seconds)
+    seconds = time_best(
+        lambda: [CommuGroup.from_commu_line(line, text_only=True) for line in lines],
+        repeat,
+    )
+    print_result("  (text_only=True)", len(lines), "lines", seconds)
+
+
+def benchmark_extract(lines: list[str], repeat: int):
+    groups = [CommuGroup.from_commu_line(line) for line in lines]
+    seconds = time_best(
+        lambda: [create_raw_data_rows(group) for group in groups], repeat
+    )
+    print_result("create_raw_data_rows", len(groups), "groups", seconds)
+    # Parsing and extracting together, as extract and inject do,
+    # compared with the text-only parse mode
+    for name, text_only in [
+        ("  (parse and extract)", False),
+        ("  (text_only=True)", True),
+    ]:
+        seconds = time_best(
+            lambda: [
+                create_dialogue_rows(
+                    CommuGroup.from_commu_line(line, text_only=text_only)
+                )
+                for line in lines
+            ],
+            repeat,
+        )
+        print_result(name, len(lines), "lines", seconds)
+
+
+def benchmark_str(lines: list[str], repeat: int):
+    groups = [CommuGroup.from_commu_line(line) for line in lines]
+    seconds = time_best(lambda: [str(group) for group in groups], repeat)
+    print_result("CommuGroup.__str__", len(groups), "groups", seconds)
+
+
+def legacy_merge_lines(
+    raw_lines: list[RawLine], existing_tl_lines: list[TranslationLine]
+):
+    # The scan-and-remove merge that merge_lines used before it indexed
+    # the existing rows, kept to compare against
+    new_tl_lines = []
+    for raw_line in raw_lines:
+        try:
+            tl_line = next(
+                tl_line
+                for tl_line in existing_tl_lines
+                if to_raw_line(tl_line) == raw_line
+            )
+            existing_tl_lines.remove(tl_line)
+        except StopIteration:
+            tl_line = to_translation_line(raw_line)
+        new_tl_lines.append(tl_line)
+    return new_tl_lines
+
+
+def create_story_rows(lines: list[str], row_count: int):
+    # Builds the rows of a long adv_unit_ story file out of the generated
+    # lines, where each row shows up about four times, along with
+    # the spreadsheet of an older version of it where every tenth row
+    # was edited since
+    groups = [CommuGroup.from_commu_line(line) for line in lines]
+    rows = [raw_line for group in groups for raw_line in create_raw_data_rows(group)]
+    raw_lines = [
+        rows[index % len(rows)]._replace(
+            text=f"{rows[index % len(rows)].text}{index % (row_count // 4)}"
+        )
+        for index in range(row_count)
+    ]
+    existing_tl_lines = [
+        to_translation_line(raw_line)._replace(translated_text=f"TL {index}")
+        for index, raw_line in enumerate(raw_lines)
+    ]
+    for index in range(0, row_count, 10):
+        raw_lines[index] = raw_lines[index]._replace(text=raw_lines[index].text + "…")
+    return raw_lines, existing_tl_lines
+
+
+def benchmark_merge(lines: list[str], repeat: int):
+    groups = [CommuGroup.from_commu_line(line) for line in lines]
+    raw_lines = [
+        raw_line for group in groups for raw_line in create_raw_data_rows(group)
+    ]
+    existing_tl_lines = [to_translation_line(raw_line) for raw_line in raw_lines]
+    seconds = time_best(lambda: merge_lines(raw_lines, existing_tl_lines), repeat)
+    print_result("merge_lines", len(raw_lines), "rows", seconds)
+
+    for row_count in (1000, 4000, 8000):
+        raw_lines, existing_tl_lines = create_story_rows(lines, row_count)
+        seconds = time_best(lambda: merge_lines(raw_lines, existing_tl_lines), repeat)
+        print_result("merge_lines (adv_unit_)", row_count, "rows", seconds)
+        # The legacy merge takes quadratic time, so it's skipped on the longest
+        # files, and it uses up the list of existing rows, so copy it each run
+        if row_count <= 4000:
+            merged_tl_lines = merge_lines(raw_lines, existing_tl_lines)
+            if merged_tl_lines != legacy_merge_lines(
+                raw_lines, list(existing_tl_lines)
+            ):
+                raise Exception("merge_lines doesn't match the legacy merge!")
+            seconds = time_best(
+                lambda: legacy_merge_lines(raw_lines, list(existing_tl_lines)), 1
+            )
+            print_result("  (legacy scan)", row_count, "rows", seconds)
+        seconds = time_best(
+            lambda: align_merge_lines(raw_lines, existing_tl_lines), repeat
+        )
+        print_result("  (align_merge_lines)", row_count, "rows", seconds)
+
+
+def benchmark_inject(lines: list[str], repeat: int):
+    groups = [CommuGroup.from_commu_line(line) for line in lines]
+    tl_lines = create_translated_lines(groups)
+    # Times the same steps as the inject subcommand, on a commu file
+    # and its translated spreadsheet
+    with tempfile.TemporaryDirectory() as directory:
+        txt_path = os.path.join(directory, "adv_bench.txt")
+        xlsx_path = os.path.join(directory, "adv_bench.xlsx")
+        output_path = os.path.join(directory, "adv_bench_out.txt")
+        with open(txt_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines))
+            file.write("\n")
+        write_tl_lines_to_spreadsheet(tl_lines, xlsx_path, "Sheet1")
+
+        seconds = time_best(lambda: parse_commu_for_injection(txt_path), repeat)
+        print_result("parse_commu_for_injection", len(lines), "lines", seconds)
+        parsed_commu = parse_commu_for_injection(txt_path)
+        seconds = time_best(lambda: inject_spreadsheet(parsed_commu, xlsx_path), repeat)
+        print_result("inject_spreadsheet", len(tl_lines), "rows", seconds)
+        line_replacements = inject_spreadsheet(parsed_commu, xlsx_path)
+        seconds = time_best(
+            lambda: write_injected_lines(
+                parsed_commu.commu_lines, line_replacements, output_path
+            ),
+            repeat,
+        )
+        print_result("write_injected_lines", len(lines), "lines", seconds)
+
+
+# The pattern the parser used to retrieve AnimationCurve values with,
+# before they had a scanner of their own
+legacy_animation_curve_pattern = re.compile(r"(AnimationCurve::\\\{\S+\\\})(?=[ \]])")
+
+
+def benchmark_json(lines: list[str], repeat: int):
+    # Stress test on single camera curves of several hundred KB,
+    # both followed by another property and at the end of nested groups
+    rng = random.Random(0)
+    for key_count in (1000, 3000, 6000):
+        curve = generate_animation_curve(rng, key_count)
+        for suffix in (" clip=x]", "]]]"):
+            string = curve + suffix
+
+            def scan():
+                parse_animation_curve_json_data(ParsingString(string))
+
+            seconds = time_best(scan, repeat)
+            size = len(curve) // 1024
+            print_result(
+                f"AnimationCurve scan ({size} KiB)", len(curve), "chars", seconds
+            )
+            seconds = time_best(
+                lambda: legacy_animation_curve_pattern.match(string), repeat
+            )
+            print_result("  (legacy pattern)", len(curve), "chars", seconds)
+
+
+def benchmark_xlsx(lines: list[str], repeat: int):
+    # Writes and reads back the spreadsheet of the lines with each codec
+    groups = [CommuGroup.from_commu_line(line) for line in lines]
+    tl_lines = create_translated_lines(groups)
+    with tempfile.TemporaryDirectory() as directory:
+        spreadsheet_path = os.path.join(directory, "adv_bench.xlsx")
+        for codec in spreadsheet_codecs:
+            seconds = time_best(
+                lambda: write_tl_lines_to_spreadsheet(
+                    tl_lines, spreadsheet_path, "Sheet1", codec=codec
+                ),
+                repeat,
+            )
+            print_result(f"write spreadsheet ({codec})", len(tl_lines), "rows", seconds)
+            seconds = time_best(
+                lambda: get_tl_lines_from_spreadsheet(
+                    spreadsheet_path, "Sheet1", codec
+                ),
+                repeat,
+            )
+            print_result(f"read spreadsheet ({codec})", len(tl_lines), "rows", seconds)
+
+
+def benchmark_formats(lines: list[str], repeat: int):
+    # Writes and reads back the translation file of the lines in each format
+    groups = [CommuGroup.from_commu_line(line) for line in lines]
+    tl_lines = create_translated_lines(groups)
+    with tempfile.TemporaryDirectory() as directory:
+        for format_name, file_format in file_formats.items():
+            file_path = os.path.join(directory, "adv_bench" + file_format.extension)
+            seconds = time_best(
+                lambda: file_format.write_tl_lines(
+                    tl_lines, file_path, "Sheet1", set()
+                ),
+                repeat,
+            )
+            print_result(f"write {format_name}", len(tl_lines), "rows", seconds)
+            seconds = time_best(
+                lambda: get_tl_lines(file_path, "Sheet1", format_name), repeat
+            )
+            print_result(f"read {format_name}", len(tl_lines), "rows", seconds)
+
+
+def benchmark_startup(lines: list[str], repeat: int):
+    # Times starting the command line tool, which scripts run once per file,
+    # against starting python alone
+    tool_directory = os.path.dirname(os.path.abspath(__file__))
+    commands = [
+        ("python startup", [sys.executable, "-c", "pass"]),
+        ("main.py --help", [sys.executable, "main.py", "--help"]),
+    ]
+    for name, command in commands:
+        seconds = time_best(
+            lambda: subprocess.run(
+                command, cwd=tool_directory, check=True, stdout=subprocess.DEVNULL
+            ),
+            repeat,
+        )
+        print(f"{name:<32} {seconds * 1000:>14.1f} ms")
+
+
+def read_spreadsheets(directory: str):
+    return {
+        file_name: get_tl_lines_from_spreadsheet(
+            os.path.join(directory, file_name), "Sheet1"
+        )
+        for file_name in sorted(os.listdir(directory))
+        if file_name.endswith(".xlsx")
+    }
+
+
+def benchmark_pipeline(lines: list[str], repeat: int):
+    # Stress test of the thread backend: extracts many small commu files
+    # with several threads for each stage, and checks that every run writes
+    # the same spreadsheets as extracting the files one after another
+    file_count = 32
+    stages = [
+        parse_commu_to_extract,
+        partial(merge_extracted_lines, force_overwrite=True),
+        write_extracted_lines,
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        txt_directory = os.path.join(directory, "txt")
+        os.makedirs(txt_directory)
+        file_names = [f"adv_stress_{index:04}" for index in range(file_count)]
+        for index, file_name in enumerate(file_names):
+            txt_path = os.path.join(txt_directory, file_name + ".txt")
+            with open(txt_path, "w", encoding="utf-8") as file:
+                file.write("\n".join(lines[index::file_count]))
+                file.write("\n")
+
+        def extract(jobs: int, backend: str):
+            xlsx_directory = tempfile.mkdtemp(dir=directory)
+            path_tuples = [
+                (
+                    os.path.join(txt_directory, file_name + ".txt"),
+                    os.path.join(xlsx_directory, file_name + ".xlsx"),
+                )
+                for file_name in file_names
+            ]
+            with redirect_stdout(io.StringIO()):
+                start_time = time.perf_counter()
+                file_stats_list = list(
+                    iter_file_jobs(stages, path_tuples, jobs, backend)
+                )
+                seconds = time.perf_counter() - start_time
+            if not all(file_stats.is_successful for file_stats in file_stats_list):
+                raise Exception(f"Extraction failed with {jobs} {backend} jobs!")
+            return read_spreadsheets(xlsx_directory), seconds
+
+        expected_spreadsheets, seconds = extract(1, "process")
+        print_result("extract (sequential)", file_count, "files", seconds)
+        for jobs in (1, 4, 16):
+            best_time = float("inf")
+            for _ in range(repeat):
+                spreadsheets, seconds = extract(jobs, "thread")
+                if spreadsheets != expected_spreadsheets:
+                    raise Exception(
+                        f"Extracting with {jobs} threads for each stage "
+                        + "wrote different spreadsheets!"
+                    )
+                best_time = min(best_time, seconds)
+            print_result(
+                f"extract ({jobs} threads/stage)", file_count, "files", best_time
+            )
+
+
+def measure_memory(function):
+    # Returns the memory still held by the result of the function
+    # and the peak memory allocated while it ran
+    # (with tracemalloc, which slows it down, so it is timed separately)
+    tracemalloc.start()
+    try:
+        result = function()
+        kept_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return kept_bytes, peak_bytes
+
+
+def benchmark_bulk(lines: list[str], repeat: int):
+    # Extracts a corpus of commu files into one RawLineTable, and compares it
+    # with keeping the list of RawLines extract_lines returns for each file
+    file_count = 20
+    with tempfile.TemporaryDirectory() as directory:
+        txt_directory = os.path.join(directory, "txt")
+        os.makedirs(txt_directory)
+        for index in range(file_count):
+            txt_path = os.path.join(txt_directory, f"adv_bulk_{index:04}.txt")
+            with open(txt_path, "w", encoding="utf-8") as file:
+                file.write("\n".join(lines[index::file_count]))
+                file.write("\n")
+        txt_paths = [
+            os.path.join(txt_directory, file_name)
+            for file_name in sorted(os.listdir(txt_directory))
+        ]
+
+        def extract_files():
+            return {txt_path: extract_lines(txt_path) for txt_path in txt_paths}
+
+        cache = ParseCache(os.path.join(directory, "cache"))
+        table = extract_directory(txt_directory, cache)
+        raw_lines_by_file = extract_files()
+        if [table.get_raw_lines(file_id) for file_id in range(file_count)] != list(
+            raw_lines_by_file.values()
+        ):
+            raise Exception("The table has different rows than extract_lines!")
+
+        for name, function in [
+            ("extract_lines (every file)", extract_files),
+            ("  (extract_directory)", lambda: extract_directory(txt_directory)),
+            (
+                "  (cached extract_directory)",
+                lambda: extract_directory(txt_directory, cache),
+            ),
+        ]:
+            seconds = time_best(function, repeat)
+            print_result(name, len(table), "rows", seconds)
+            kept_bytes, peak_bytes = measure_memory(function)
+            print(
+                f"{'':<32} {kept_bytes / 1024:>14,.0f} KiB kept"
+                + f" ({peak_bytes / 1024:,.0f} KiB peak)"
+            )
+
+
+benchmarks = {
+    "parse": benchmark_parse,
+    "extract": benchmark_extract,
+    "str": benchmark_str,
+    "merge": benchmark_merge,
+    "inject": benchmark_inject,
+    "json": benchmark_json,
+    "xlsx": benchmark_xlsx,
+    "formats": benchmark_formats,
+    "startup": benchmark_startup,
+    "pipeline": benchmark_pipeline,
+    "bulk": benchmark_bulk,
+}
+
+
+def create_argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the commu parser and the extract/inject pipeline "
+        + "on generated commu lines",
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        choices=list(benchmarks),
+        help="The benchmarks to run (all of them by default)",
+    )
+    parser.add_argument(
+        "-n", "--lines", type=int, default=2000, help="Number of commu lines"
+    )
+    parser.add_argument(
+        "-k",
+        "--curve-keys",
+        type=int,
+        default=200,
+        help="Number of keys in each camera AnimationCurve",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Runs of each benchmark"
+    )
+    parser.add_argument(
+        "--write-corpus",
+        metavar="DIRECTORY",
+        help="Writes generated commu files to the directory instead of benchmarking",
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=20,
+        help="Number of commu files written by --write-corpus",
+    )
+    return parser
+
+
+def main():
+    args = create_argument_parser().parse_args(sys.argv[1:])
+    if args.write_corpus:
+        write_commu_corpus(args.write_corpus, args.files, args.lines, args.curve_keys)
+        print(f"Wrote {args.files} commu files to {args.write_corpus}")
+        return
+
+    lines = generate_commu_lines(args.lines, args.curve_keys)
+    total_size = sum(len(line) for line in lines)
+    print(f"{len(lines):,} commu lines, {total_size / 1024:,.0f} KiB")
+    for name in args.benchmarks or benchmarks:
+        benchmarks[name](lines, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
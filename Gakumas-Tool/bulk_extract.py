@@ -0,0 +1,121 @@
+import os
+import sys
+from array import array
+from data_types import RawLine
+from extract_lines import iter_commu_groups, iter_dialogue_groups
+from parse_cache import ParseCache, read_commu_file
+
+
+class RawLineTable:
+    # Holds the raw lines of many commu files as parallel columns
+    # instead of one RawLine per row
+    # The rows of a file are stored next to each other, so the rows of
+    # file number i are rows file_row_starts[i] to file_row_starts[i + 1]
+    file_paths: list[str]
+    file_row_starts: array
+    file_ids: array
+    line_numbers: array
+    group_types: list[str]
+    names: list[str]
+    texts: list[str]
+
+    def __init__(self):
+        self.file_paths = []
+        self.file_row_starts = array("L", [0])
+        self.file_ids = array("L")
+        self.line_numbers = array("L")
+        self.group_types = []
+        self.names = []
+        self.texts = []
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def add_row(
+        self, file_id: int, line_number: int, group_type: str, name: str, text: str
+    ):
+        self.file_ids.append(file_id)
+        self.line_numbers.append(line_number)
+        # Group types and names repeat across the whole corpus,
+        # so the table shares one string for each of them
+        # Texts are mostly unique, so they are stored as they are
+        self.group_types.append(sys.intern(group_type))
+        self.names.append(sys.intern(name))
+        self.texts.append(text)
+
+    def add_file(self, file_path: str, cache: ParseCache | None = None) -> int:
+        # Extracts the raw lines of a commu file into the table,
+        # and returns the id of the file
+        # The columns are filled straight from the parsed groups
+        # (or the rows in the parse cache), without creating a row object
+        file_id = len(self.file_paths)
+        content, lines = read_commu_file(file_path)
+        cache_rows = cache.load_rows(content) if cache is not None else None
+        if cache_rows is not None:
+            for line_number, group_type, name, text, _, _ in cache_rows:
+                self.add_row(file_id, line_number, group_type, name, text)
+        else:
+            # The rows are only kept for the cache if there is one
+            cache_rows = [] if cache is not None else None
+            for line_number, group in iter_commu_groups(lines, file_path):
+                for nested_group, name, text in iter_dialogue_groups(group):
+                    group_type = nested_group.group_type
+                    self.add_row(file_id, line_number, group_type, name, text)
+                    if cache_rows is not None:
+                        cache_rows.append(
+                            [
+                                line_number,
+                                group_type,
+                                name,
+                                text,
+                                nested_group.get_property_spans("name"),
+                                nested_group.get_property_spans("text"),
+                            ]
+                        )
+            if cache is not None:
+                cache.store_rows(content, cache_rows)
+        self.file_paths.append(file_path)
+        self.file_row_starts.append(len(self.file_ids))
+        return file_id
+
+    def get_raw_lines(self, file_id: int) -> list[RawLine]:
+        # Returns the rows of a file in the form extract_lines returns them,
+        # so they can be given to save_to_excel
+        # Row objects are only created for the one file being written
+        start = self.file_row_starts[file_id]
+        end = self.file_row_starts[file_id + 1]
+        return list(
+            map(
+                RawLine,
+                self.group_types[start:end],
+                self.names[start:end],
+                self.texts[start:end],
+            )
+        )
+
+    def to_columns(self) -> dict[str, list]:
+        # Returns the table as a dict of equal length columns,
+        # with the file ids replaced by the file paths
+        return {
+            "file_path": [self.file_paths[file_id] for file_id in self.file_ids],
+            "line_number": self.line_numbers.tolist(),
+            "group_type": self.group_types,
+            "name": self.names,
+            "text": self.texts,
+        }
+
+
+def is_commu_file_name(file_name: str):
+    return file_name.startswith("adv") and file_name.endswith(".txt")
+
+
+def extract_directory(
+    txt_directory: str, cache: ParseCache | None = None
+) -> RawLineTable:
+    # Extracts the raw lines of every commu file in the directory
+    # into a single table
+    table = RawLineTable()
+    for file_name in sorted(os.listdir(txt_directory)):
+        if is_commu_file_name(file_name):
+            table.add_file(os.path.join(txt_directory, file_name), cache)
+    return table
@@ -1,87 +1,174 @@
 import re
+import sys
 
 
 class ParsingString:
     def __init__(self, string: str):
         self.string = string
+        # Index of the first character that has not been parsed yet
+        # We move this cursor forward instead of slicing the string,
+        # so parsing a line doesn't copy the rest of the line for every token
+        self.position = 0
 
     def retrieve(self, pattern: re.Pattern[str] | str):
-        # Attempts to match the string with the pattern
-        # Removes the whole match from the string,
+        # Attempts to match the string at the cursor with the pattern
+        # Moves the cursor past the whole match,
         # and returns the first group of the match
-        # Note re.match only matches the start of the string
-        match = re.match(pattern, self.string)
+        # Note Pattern.match only matches at the given position
+        match = compile_pattern(pattern).match(self.string, self.position)
         if not match:
             raise Exception(
                 f"Failed to retrieve pattern\n{pattern}\n"
-                + f"from string\n{self.string}"
+                + f"from string\n{self.string[self.position :]}"
             )
-        self.string = self.string[match.end() :]
+        self.position = match.end()
         return match.group(1)
 
+    def skip(self, pattern: re.Pattern[str]):
+        # Like retrieve, but doesn't copy the match out of the string
+        match = pattern.match(self.string, self.position)
+        if not match:
+            raise Exception(
+                f"Failed to retrieve pattern\n{pattern}\n"
+                + f"from string\n{self.string[self.position :]}"
+            )
+        self.position = match.end()
+
     def peek(self, pattern: re.Pattern[str] | str):
-        match = re.match(pattern, self.string)
+        match = compile_pattern(pattern).match(self.string, self.position)
         return bool(match)
 
     def is_empty(self):
-        return self.string == ""
+        return self.position == len(self.string)
+
+
+def compile_pattern(pattern: re.Pattern[str] | str) -> re.Pattern[str]:
+    if isinstance(pattern, str):
+        return re.compile(pattern)
+    return pattern
 
 
 type PropertyValue = str | CommuGroup
 
 
 class CommuGroup:
-    def __init__(self, group_type: str):
+    # Whole seasons of commus can be held in memory at once,
+    # so groups don't get a __dict__, and a key that only appears once
+    # in a group has its value stored directly instead of in a list
+    __slots__ = ("group_type", "properties", "raw_text", "dialogue_spans")
+
+    def __init__(self, group_type: str, raw_text: str | None = None):
         self.group_type = group_type
-        self.properties: dict[str, list[PropertyValue]] = {}
+        self.properties: dict[str, PropertyValue | list[PropertyValue]] = {}
+        # Groups skipped by the text-only parse mode have no properties,
+        # and keep the original text of the group so it can be written back
+        self.raw_text = raw_text
+        # Where the name and text values of a parsed group are in the line,
+        # as (key, start, end) tuples, so they can be replaced in place
+        self.dialogue_spans: list[tuple[str, int, int]] | None = None
 
     def append_property(self, key: str, value: PropertyValue):
         if key not in self.properties:
-            self.properties[key] = [value]
+            self.properties[key] = value
         else:
-            self.properties[key].append(value)
+            existing_value = self.properties[key]
+            if isinstance(existing_value, list):
+                existing_value.append(value)
+            else:
+                self.properties[key] = [existing_value, value]
 
     def get_property(self, key: str, defaultValue: PropertyValue):
         if key not in self.properties:
             return defaultValue
-        found_properties = self.properties[key]
-        if len(found_properties) == 1:
-            return found_properties[0]
+        found_property = self.properties[key]
+        if not isinstance(found_property, list):
+            return found_property
         else:
             raise Exception(f"More than one property with key '{key}' found in group!")
 
-    def get_property_list(self, key: str):
-        return self.properties[key]
+    def add_dialogue_span(self, key: str, start: int, end: int):
+        if self.dialogue_spans is None:
+            self.dialogue_spans = []
+        self.dialogue_spans.append((key, start, end))
+
+    def get_property_spans(self, key: str) -> list[tuple[int, int]]:
+        # Returns the positions of the values of the key in the parsed line
+        # (after it is stripped), only name and text values are recorded
+        if self.dialogue_spans is None:
+            return []
+        return [
+            (start, end)
+            for span_key, start, end in self.dialogue_spans
+            if span_key == key
+        ]
+
+    def get_property_list(self, key: str) -> list[PropertyValue]:
+        found_property = self.properties[key]
+        if isinstance(found_property, list):
+            return found_property
+        else:
+            return [found_property]
+
+    def iter_properties(self):
+        # Yields every key and value pair, in the order they were added
+        # (values of a repeated key are yielded together)
+        for key, value in self.properties.items():
+            if isinstance(value, list):
+                for list_value in value:
+                    yield key, list_value
+            else:
+                yield key, value
+
+    def iter_groups(self):
+        # Yields this group and all groups nested in it, in pre-order,
+        # using an explicit stack instead of recursion
+        stack: list[CommuGroup] = [self]
+        while stack:
+            group = stack.pop()
+            yield group
+            stack.extend(reversed(group.get_children()))
 
     def get_children(self):
         return [
             value
-            for property_list in self.properties.values()
-            for value in property_list
+            for _, value in self.iter_properties()
             if isinstance(value, CommuGroup)
         ]
 
-    def modify_property(self, key: str, value: PropertyValue):
-        if key in self.properties:
-            self.properties[key] = [value for _ in self.properties[key]]
-
     @classmethod
-    def from_commu_line(cls, text_to_parse: str):
+    def from_commu_line(cls, text_to_parse: str, text_only: bool = False):
+        # In text-only mode, only the groups that have a name or text
+        # (or have children that do) are parsed into properties,
+        # and every other group is kept as an opaque group
         parsing_string = ParsingString(text_to_parse.strip())
-        group = parse_group(parsing_string)
+        group = parse_group(parsing_string, text_only)
         if not parsing_string.is_empty():
             raise Exception("Additional text found on the end of text to parse!")
         return group
 
     def __str__(self):
+        if self.raw_text is not None:
+            return self.raw_text
         parts = [self.group_type] + [
             f"{key}={property_value_to_string(value)}"
-            for key, values in self.properties.items()
-            for value in values
+            for key, value in self.iter_properties()
         ]
         return "[" + " ".join(parts) + "]"
 
 
+def splice_line(line: str, replacements: list[tuple[int, int, str]]):
+    # Replaces the (start, end) spans of the line with the given strings,
+    # copying everything in between as it is
+    parts = []
+    position = 0
+    for start, end, replacement in sorted(replacements):
+        parts.append(line[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(line[position:])
+    return "".join(parts)
+
+
 def unescape_string(string: str):
     return string.replace("\\n", "\n")
 
@@ -97,46 +184,231 @@ def property_value_to_string(value: PropertyValue):
         return str(value)
 
 
+# The patterns used by the parser are compiled once on import
+group_start_pattern = re.compile(r"(\[)")
+group_end_pattern = re.compile(r"(\])")
+group_end_peek_pattern = re.compile(r"\]")
+space_pattern = re.compile(r"( )")
+group_type_pattern = re.compile(r"([a-z]+)(?=[ \]])")
+key_pattern = re.compile(r"([A-Za-z]+)=")
+# The first match-group consists of any character except
+# linebreak, backslash, square brackets, and equals, unless they are
+# in the combinations '\n' or '\='
+string_data_pattern = re.compile(r"((?:[^\n\\\[\]=]|\\n|\\=)+)(?=[ \]])")
+json_data_peek_pattern = re.compile(r"\\\{")
+animation_curve_json_data_peek_pattern = re.compile(r"AnimationCurve::\\\{")
+
+
+# The keys that hold the strings we extract and inject
+dialogue_keys = ("name", "text")
+
+
+# Group types and keys are interned, since the same few of them
+# are repeated on every line
 def parse_group_type(parsing_string: ParsingString):
-    return parsing_string.retrieve(r"([a-z]+)(?=[ \]])")
+    return sys.intern(parsing_string.retrieve(group_type_pattern))
 
 
 # This function gobbles up the = as well!
 def parse_key(parsing_string: ParsingString):
-    return parsing_string.retrieve(r"([A-Za-z]+)=")
+    return sys.intern(parsing_string.retrieve(key_pattern))
 
 
 def parse_string_data(parsing_string: ParsingString):
-    # The first match-group consists of any character except
-    # linebreak, backslash, square brackets, and equals, unless they are
-    # in the combinations '\n' or '\='
-    return parsing_string.retrieve(r"((?:[^\n\\\[\]=]|\\n|\\=)+)(?=[ \]])")
+    return parsing_string.retrieve(string_data_pattern)
+
+
+non_space_pattern = re.compile(r"\S*")
+json_data_prefix = "\\{"
+json_data_suffix = "\\}"
+animation_curve_json_data_prefix = "AnimationCurve::\\{"
+
+
+def skip_json_data(parsing_string: ParsingString, prefix: str):
+    # Moves the cursor past a json value like \{...\} or AnimationCurve::\{...\},
+    # which can be the longest values in a commu line
+    # Json values can't contain spaces, so the value is in the run of
+    # non-space characters at the cursor, and it ends at the last \}
+    # of the run that is followed by a space or by a ] closing a group
+    # This finds the same end as the pattern (prefix\S+\\\})(?=[ \]]),
+    # but with one pass over the run and a search back from its end,
+    # so the value is never backtracked over
+    string = parsing_string.string
+    value_start = parsing_string.position
+    # The value needs at least one character between the braces
+    min_value_end = value_start + len(prefix) + 1 + len(json_data_suffix)
+    run_end = non_space_pattern.match(string, value_start).end()
+    if string.startswith(json_data_suffix, run_end - 2) and string.startswith(
+        " ", run_end
+    ):
+        value_end = run_end
+    else:
+        suffix_start = string.rfind(
+            json_data_suffix + "]", min_value_end - len(json_data_suffix), run_end
+        )
+        value_end = suffix_start + len(json_data_suffix) if suffix_start >= 0 else -1
+    if value_end < min_value_end or not string.startswith(prefix, value_start):
+        raise Exception(
+            f"Failed to retrieve json data starting with\n{prefix}\n"
+            + f"from string\n{string[value_start:]}"
+        )
+    parsing_string.position = value_end
+
+
+def scan_json_data(parsing_string: ParsingString, prefix: str):
+    value_start = parsing_string.position
+    skip_json_data(parsing_string, prefix)
+    return parsing_string.string[value_start : parsing_string.position]
 
 
 def parse_json_data(parsing_string: ParsingString):
-    return parsing_string.retrieve(r"(\\\{\S+\\\})(?=[ \]])")
+    return scan_json_data(parsing_string, json_data_prefix)
 
 
 def parse_animation_curve_json_data(parsing_string: ParsingString):
-    return parsing_string.retrieve(r"(AnimationCurve::\\\{\S+\\\})(?=[ \]])")
+    return scan_json_data(parsing_string, animation_curve_json_data_prefix)
+
+
+def parse_data(parsing_string: ParsingString) -> str:
+    # Parses a property value that isn't a group
+    if parsing_string.peek(animation_curve_json_data_peek_pattern):
+        return parse_animation_curve_json_data(parsing_string)
+    elif parsing_string.peek(json_data_peek_pattern):
+        return parse_json_data(parsing_string)
+    else:
+        return unescape_string(parse_string_data(parsing_string))
+
+
+def skip_data(parsing_string: ParsingString) -> bool:
+    # Moves the cursor past a property value that isn't a group,
+    # without copying it, and returns whether it is string data,
+    # which needs to be unescaped
+    if parsing_string.peek(animation_curve_json_data_peek_pattern):
+        skip_json_data(parsing_string, animation_curve_json_data_prefix)
+        return False
+    elif parsing_string.peek(json_data_peek_pattern):
+        skip_json_data(parsing_string, json_data_prefix)
+        return False
+    else:
+        parsing_string.skip(string_data_pattern)
+        return True
+
+
+def parse_group(parsing_string: ParsingString, text_only: bool = False) -> CommuGroup:
+    if text_only:
+        return parse_group_text_only(parsing_string)
+
+    # Nested groups are parsed with an explicit stack of the groups
+    # that are still open, instead of recursion
+    root_group = parse_group_start(parsing_string)
+    open_groups = [root_group]
+    while open_groups:
+        group = open_groups[-1]
+        if parsing_string.peek(group_end_peek_pattern):
+            parsing_string.retrieve(group_end_pattern)
+            open_groups.pop()
+            continue
+        parsing_string.retrieve(space_pattern)
+        key = parse_key(parsing_string)
+        if parsing_string.peek(group_start_pattern):
+            child_group = parse_group_start(parsing_string)
+            group.append_property(key, child_group)
+            open_groups.append(child_group)
+        else:
+            value_start = parsing_string.position
+            value = parse_data(parsing_string)
+            if key in dialogue_keys:
+                group.add_dialogue_span(key, value_start, parsing_string.position)
+            group.append_property(key, value)
+    return root_group
+
+
+def parse_group_start(parsing_string: ParsingString) -> CommuGroup:
+    parsing_string.retrieve(group_start_pattern)
+    return CommuGroup(parse_group_type(parsing_string))
+
+
+class OpenGroup:
+    # A group being parsed in text-only mode, whose properties are held
+    # until the group is closed, since only then is it known whether
+    # the group or one of its children has a name or text
+    # Values are held as their positions in the line, and only copied
+    # out of it if the group is kept
+    __slots__ = ("start", "group_type", "key", "has_dialogue", "properties", "spans")
+
+    def __init__(self, start: int, group_type: str, key: str | None):
+        self.start = start
+        self.group_type = group_type
+        # The key of the group in its parent group
+        self.key = key
+        self.has_dialogue = False
+        # (key, child group) for groups, and
+        # (key, value start, value end, is string data) for other values
+        self.properties: list[tuple] = []
+        self.spans: list[tuple[str, int, int]] | None = None
+
+    def close(self, string: str, end: int) -> CommuGroup:
+        if not self.has_dialogue:
+            return CommuGroup(self.group_type, string[self.start : end])
+        group = CommuGroup(self.group_type)
+        properties = group.properties
+        for buffered_property in self.properties:
+            if len(buffered_property) == 2:
+                key, value = buffered_property
+            else:
+                key, value_start, value_end, is_string_data = buffered_property
+                value = string[value_start:value_end]
+                if is_string_data:
+                    value = unescape_string(value)
+            # Most keys only appear once in a group
+            if key in properties:
+                group.append_property(key, value)
+            else:
+                properties[key] = value
+        group.dialogue_spans = self.spans
+        return group
 
 
-def parse_group(parsing_string: ParsingString) -> CommuGroup:
-    parsing_string.retrieve(r"(\[)")
-    group_type = parse_group_type(parsing_string)
-    group = CommuGroup(group_type)
-    while not parsing_string.peek(r"\]"):
-        parsing_string.retrieve(r"( )")
+def open_group(parsing_string: ParsingString, key: str | None) -> OpenGroup:
+    group_start = parsing_string.position
+    parsing_string.retrieve(group_start_pattern)
+    return OpenGroup(group_start, parse_group_type(parsing_string), key)
+
+
+def parse_group_text_only(parsing_string: ParsingString) -> CommuGroup:
+    # Parses the group in one pass like parse_group, but only the groups
+    # that have a name or text (or have children that do) get properties,
+    # and every other group is kept as an opaque group with its original text
+    # The values of the properties are scanned either way, so the whole
+    # group is still checked to be well-formed
+    string = parsing_string.string
+    open_groups = [open_group(parsing_string, None)]
+    while True:
+        group = open_groups[-1]
+        if parsing_string.peek(group_end_peek_pattern):
+            parsing_string.retrieve(group_end_pattern)
+            open_groups.pop()
+            closed_group = group.close(string, parsing_string.position)
+            if not open_groups:
+                return closed_group
+            parent_group = open_groups[-1]
+            parent_group.properties.append((group.key, closed_group))
+            if group.has_dialogue:
+                parent_group.has_dialogue = True
+            continue
+        parsing_string.retrieve(space_pattern)
         key = parse_key(parsing_string)
-        value: PropertyValue
-        if parsing_string.peek(r"\["):
-            value = parse_group(parsing_string)
-        elif parsing_string.peek(r"AnimationCurve::\\\{"):
-            value = parse_animation_curve_json_data(parsing_string)
-        elif parsing_string.peek(r"\\\{"):
-            value = parse_json_data(parsing_string)
+        if parsing_string.peek(group_start_pattern):
+            if key in dialogue_keys:
+                group.has_dialogue = True
+            open_groups.append(open_group(parsing_string, key))
         else:
-            value = unescape_string(parse_string_data(parsing_string))
-        group.append_property(key, value)
-    parsing_string.retrieve(r"(\])")
-    return group
+            value_start = parsing_string.position
+            is_string_data = skip_data(parsing_string)
+            value_end = parsing_string.position
+            if key in dialogue_keys:
+                group.has_dialogue = True
+                if group.spans is None:
+                    group.spans = []
+                group.spans.append((key, value_start, value_end))
+            group.properties.append((key, value_start, value_end, is_string_data))
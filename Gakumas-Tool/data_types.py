@@ -7,9 +7,21 @@ class RawLine(NamedTuple):
     text: str
 
 
+class DialogueRow(NamedTuple):
+    raw_line: RawLine
+    # Where the name and text values are in the stripped commu line
+    name_spans: list[tuple[int, int]]
+    text_spans: list[tuple[int, int]]
+
+
 class TranslationLine(NamedTuple):
     group_type: str
     name: str
     translated_name: str
     text: str
     translated_text: str
+
+
+class LineParseError(NamedTuple):
+    line_number: int
+    message: str
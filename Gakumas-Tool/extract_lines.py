@@ -1,29 +1,73 @@
+from typing import Iterable, Iterator
 from commu_parser import CommuGroup
-from data_types import RawLine
+from data_types import DialogueRow, LineParseError, RawLine
+
+
+def iter_dialogue_groups(group: CommuGroup) -> Iterator[tuple[CommuGroup, str, str]]:
+    # Yields the group and the nested groups that have a name or text,
+    # with their names and texts
+    # Nested groups are visited in pre-order, so their rows come
+    # right after the row of the group containing them
+    for nested_group in group.iter_groups():
+        group_name = nested_group.get_property("name", "")
+        group_text = nested_group.get_property("text", "")
+        if not (group_name == "" and group_text == ""):
+            yield nested_group, group_name, group_text
+
+
+def create_dialogue_rows(group: CommuGroup) -> list[DialogueRow]:
+    return [
+        DialogueRow(
+            raw_line=RawLine(
+                group_type=nested_group.group_type,
+                name=group_name,
+                text=group_text,
+            ),
+            name_spans=nested_group.get_property_spans("name"),
+            text_spans=nested_group.get_property_spans("text"),
+        )
+        for nested_group, group_name, group_text in iter_dialogue_groups(group)
+    ]
 
 
 def create_raw_data_rows(group: CommuGroup) -> list[RawLine]:
-    group_type = group.group_type
-    group_name = group.get_property("name", "")
-    group_text = group.get_property("text", "")
-    if not (group_name == "" and group_text == ""):
-        raw_data_rows = [
-            RawLine(group_type=group_type, name=group_name, text=group_text)
-        ]
-    else:
-        raw_data_rows = []
-    raw_data_rows.extend(
-        raw_line
-        for child_group in group.get_children()
-        for raw_line in create_raw_data_rows(child_group)
-    )
-    return raw_data_rows
+    return [dialogue_row.raw_line for dialogue_row in create_dialogue_rows(group)]
 
 
-def extract_lines(file_path):
+def iter_commu_groups(
+    lines: Iterable[str],
+    file_path,
+    parse_errors: list[LineParseError] | None = None,
+) -> Iterator[tuple[int, CommuGroup]]:
+    # Parses each commu line, and yields the group
+    # with the number of the line it came from
+    # The full parse is used, since the groups are only kept until their
+    # rows are created, and the text-only mode isn't any faster
+    # If a list is given for parse_errors, lines that fail to parse are
+    # added to it and skipped, otherwise the error is raised
+    for line_number, line in enumerate(lines, start=1):
+        try:
+            group = CommuGroup.from_commu_line(line)
+        except Exception as e:
+            if parse_errors is None:
+                raise Exception(
+                    f"Failed to parse line {line_number} of {file_path}"
+                ) from e
+            parse_errors.append(LineParseError(line_number, str(e)))
+            continue
+        yield line_number, group
+
+
+def iter_raw_lines(
+    file_path, parse_errors: list[LineParseError] | None = None
+) -> Iterator[tuple[int, RawLine]]:
+    # Reads the commu file one line at a time, and yields each raw line
+    # with the number of the commu line it came from
     with open(file_path, "r", encoding="utf-8") as file:
-        return [
-            raw_line
-            for line in file
-            for raw_line in create_raw_data_rows(CommuGroup.from_commu_line(line))
-        ]
+        for line_number, group in iter_commu_groups(file, file_path, parse_errors):
+            for raw_line in create_raw_data_rows(group):
+                yield line_number, raw_line
+
+
+def extract_lines(file_path):
+    return [raw_line for _, raw_line in iter_raw_lines(file_path)]
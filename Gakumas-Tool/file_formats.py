@@ -0,0 +1,139 @@
+import json
+import re
+from typing import Callable, Iterator, NamedTuple
+from data_types import TranslationLine
+from spreadsheet import (
+    column_headers,
+    convert_to_string,
+    iter_tl_lines_from_rows,
+    iter_tl_lines_from_spreadsheet,
+    write_tl_lines_to_spreadsheet,
+)
+
+# The file formats translation lines can be extracted to and injected from
+# Besides xlsx spreadsheets, there are plain text formats for scripts
+# and diffs, which are much faster to read and write:
+#   tsv: the same columns as the spreadsheets, separated by tabs,
+#     with tabs, newlines and backslashes escaped as \t, \n and \\
+#   jsonl: a json object for each row, with the fields of TranslationLine
+# Every format reads and writes the same translation lines, and only
+# the spreadsheets can highlight rows for review, or have worksheets
+
+
+class FileFormat(NamedTuple):
+    extension: str
+    # Called with the path and the worksheet name, and yields the lines
+    iter_tl_lines: Callable[[str, str], Iterator[TranslationLine]]
+    # Called with the lines, the path, the worksheet name
+    # and the indices of the rows to highlight for review
+    write_tl_lines: Callable[[list[TranslationLine], str, str, set[int]], None]
+
+
+tsv_escapes = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"}
+tsv_unescapes = {escape: character for character, escape in tsv_escapes.items()}
+tsv_escape_pattern = re.compile(r"[\\\t\n\r]")
+tsv_unescape_pattern = re.compile(r"\\[\\tnr]")
+
+
+def escape_tsv_value(value: str):
+    return tsv_escape_pattern.sub(lambda match: tsv_escapes[match.group()], value)
+
+
+def unescape_tsv_value(value: str):
+    return tsv_unescape_pattern.sub(lambda match: tsv_unescapes[match.group()], value)
+
+
+def split_tsv_line(tsv_path: str, line_number: int, line: str):
+    # Rows with fewer columns are padded, since some editors drop
+    # trailing empty columns, but rows with more columns are an error,
+    # since a tab that wasn't escaped would cut the translation short
+    values = line.rstrip("\r\n").split("\t")
+    if len(values) > len(column_headers):
+        raise Exception(
+            f"Line {line_number} of {tsv_path} has {len(values)} columns "
+            + f"instead of {len(column_headers)}! "
+            + "Tabs in the text need to be written as \\t"
+        )
+    padding = [""] * (len(column_headers) - len(values))
+    return tuple(unescape_tsv_value(value) for value in values + padding)
+
+
+def iter_tl_lines_from_tsv(
+    tsv_path: str, worksheet_name: str
+) -> Iterator[TranslationLine]:
+    # Blank lines are skipped like blank rows
+    with open(tsv_path, "r", encoding="utf-8", newline="") as file:
+        rows = (
+            split_tsv_line(tsv_path, line_number, line)
+            for line_number, line in enumerate(file, 1)
+            if line.strip("\r\n") != ""
+        )
+        yield from iter_tl_lines_from_rows(rows)
+
+
+def write_tl_lines_to_tsv(
+    tl_lines: list[TranslationLine],
+    tsv_path: str,
+    worksheet_name: str,
+    review_rows: frozenset[int] | set[int] = frozenset(),
+):
+    with open(tsv_path, "w", encoding="utf-8", newline="") as file:
+        for row in [column_headers, *tl_lines]:
+            file.write("\t".join(escape_tsv_value(value) for value in row))
+            file.write("\n")
+
+
+def iter_tl_lines_from_jsonl(
+    jsonl_path: str, worksheet_name: str
+) -> Iterator[TranslationLine]:
+    with open(jsonl_path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            if line.strip() == "":
+                continue
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise Exception(
+                    f"Line {line_number} of {jsonl_path} is not a json object!"
+                )
+            if set(row) != set(TranslationLine._fields):
+                raise Exception(
+                    f"Line {line_number} of {jsonl_path} has the wrong keys! "
+                    + f"Expected keys\n{",".join(TranslationLine._fields)}\n"
+                    + f"but the line has keys\n{",".join(row)}"
+                )
+            yield TranslationLine(
+                *(convert_to_string(row[field]) for field in TranslationLine._fields)
+            )
+
+
+def write_tl_lines_to_jsonl(
+    tl_lines: list[TranslationLine],
+    jsonl_path: str,
+    worksheet_name: str,
+    review_rows: frozenset[int] | set[int] = frozenset(),
+):
+    with open(jsonl_path, "w", encoding="utf-8", newline="\n") as file:
+        for tl_line in tl_lines:
+            file.write(json.dumps(tl_line._asdict(), ensure_ascii=False))
+            file.write("\n")
+
+
+file_formats = {
+    "xlsx": FileFormat(
+        ".xlsx", iter_tl_lines_from_spreadsheet, write_tl_lines_to_spreadsheet
+    ),
+    "tsv": FileFormat(".tsv", iter_tl_lines_from_tsv, write_tl_lines_to_tsv),
+    "jsonl": FileFormat(".jsonl", iter_tl_lines_from_jsonl, write_tl_lines_to_jsonl),
+}
+
+
+def get_file_format(format_name: str) -> FileFormat:
+    if format_name not in file_formats:
+        raise Exception(f"Unknown file format {format_name}!")
+    return file_formats[format_name]
+
+
+def get_tl_lines(
+    file_path: str, worksheet_name: str, format_name: str = "xlsx"
+) -> list[TranslationLine]:
+    return list(get_file_format(format_name).iter_tl_lines(file_path, worksheet_name))
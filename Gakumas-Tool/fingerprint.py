@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+from atomic_write import write_json_atomically
+from data_types import RawLine
+
+# Sidecar files that remember a hash of the raw columns (type, name, text)
+# of each spreadsheet, so an unchanged spreadsheet can be skipped
+# without loading it
+# Each spreadsheet has its own sidecar, so files processed in parallel
+# never write to the same file
+fingerprint_directory_name = ".fingerprints"
+fingerprint_version = 1
+
+
+def get_raw_lines_fingerprint(raw_lines: list[RawLine]) -> str:
+    # The rows are hashed as a json list, so the boundaries between
+    # fields and rows are unambiguous
+    raw_lines_json = json.dumps(raw_lines, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw_lines_json.encode("utf-8")).hexdigest()
+
+
+def get_fingerprint_path(spreadsheet_path: str):
+    directory, file_name = os.path.split(spreadsheet_path)
+    return os.path.join(directory, fingerprint_directory_name, file_name + ".json")
+
+
+def read_fingerprint(spreadsheet_path: str) -> str | None:
+    # Returns the fingerprint of the spreadsheet's raw columns, or None
+    # if there is none or the spreadsheet changed since it was written
+    try:
+        with open(
+            get_fingerprint_path(spreadsheet_path), "r", encoding="utf-8"
+        ) as file:
+            sidecar = json.load(file)
+        spreadsheet_stat = os.stat(spreadsheet_path)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (
+        sidecar.get("version") != fingerprint_version
+        or sidecar.get("size") != spreadsheet_stat.st_size
+        or sidecar.get("mtime_ns") != spreadsheet_stat.st_mtime_ns
+    ):
+        return None
+    return sidecar.get("fingerprint")
+
+
+def write_fingerprint(spreadsheet_path: str, fingerprint: str):
+    # Remembers the fingerprint along with the current size and
+    # modification time of the spreadsheet, so that editing the
+    # spreadsheet afterwards invalidates it
+    fingerprint_path = get_fingerprint_path(spreadsheet_path)
+    os.makedirs(os.path.dirname(fingerprint_path), exist_ok=True)
+    spreadsheet_stat = os.stat(spreadsheet_path)
+    write_json_atomically(
+        fingerprint_path,
+        {
+            "version": fingerprint_version,
+            "size": spreadsheet_stat.st_size,
+            "mtime_ns": spreadsheet_stat.st_mtime_ns,
+            "fingerprint": fingerprint,
+        },
+    )
@@ -1,19 +1,18 @@
-from typing import Iterator
-from data_types import TranslationLine
-from commu_parser import CommuGroup
-from spreadsheet import get_tl_lines_from_spreadsheet
+from contextlib import closing
+from data_types import DialogueRow, TranslationLine
+from commu_parser import escape_string, splice_line
+from instrumentation import FileStats, add_count, measure_stage
+from parse_cache import ParseCache, ParsedCommu, parse_commu_file
+from file_formats import get_file_format
 
 
-def inject_tl_line_no_children(
-    group: CommuGroup,
+def inject_tl_line(
+    dialogue_row: DialogueRow,
     group_line_number: int,
     tl_lines_iterator: enumerate[TranslationLine],
+    replacements: list[tuple[int, int, str]],
 ):
-    group_type = group.group_type
-    group_name = group.get_property("name", "")
-    group_text = group.get_property("text", "")
-    if group_name == "" and group_text == "":
-        return
+    group_type, group_name, group_text = dialogue_row.raw_line
 
     try:
         tl_line_index, tl_line = tl_lines_iterator.__next__()
@@ -50,37 +49,93 @@ def inject_tl_line_no_children(
     translated_text = (
         tl_line.translated_text if tl_line.translated_text != "" else tl_line.text
     )
-    group.modify_property("name", translated_name)
-    group.modify_property("text", translated_text)
+    # Instead of modifying the group, we remember which parts of the
+    # commu line need to be replaced with the escaped translations
+    for spans, translated_value in (
+        (dialogue_row.name_spans, translated_name),
+        (dialogue_row.text_spans, translated_text),
+    ):
+        replacements.extend(
+            (start, end, escape_string(translated_value)) for start, end in spans
+        )
 
 
-def inject_tl_lines(
-    group: CommuGroup,
-    group_line_number: int,
-    tl_lines_iterator: enumerate[TranslationLine],
-):
-    inject_tl_line_no_children(group, group_line_number, tl_lines_iterator)
-    for child_group in group.get_children():
-        inject_tl_lines(child_group, group_line_number, tl_lines_iterator)
+def parse_commu_for_injection(
+    txt_path, cache: ParseCache | None = None, stats: FileStats | None = None
+) -> ParsedCommu:
+    # Read commu lines from the text file, and parse them into rows
+    # (or get the rows from the cache if the file hasn't changed)
+    # The rows remember where their names and texts are in the lines
+    with measure_stage(stats, "parse"):
+        parsed_commu = parse_commu_file(txt_path, cache=cache)
+    add_count(stats, "commu lines", len(parsed_commu.commu_lines))
+    add_count(stats, "rows", len(parsed_commu.dialogue_rows))
+    return parsed_commu
 
 
-def inject_translations(txt_path, xlsx_path, output_path):
-    # Read lines from the spreadsheet
-    tl_lines = get_tl_lines_from_spreadsheet(xlsx_path, "Sheet1")
+def inject_spreadsheet(
+    parsed_commu: ParsedCommu,
+    xlsx_path,
+    stats: FileStats | None = None,
+    format_name: str = "xlsx",
+) -> list[list[tuple[int, int, str]]]:
+    # Inject translations into the commu lines
+    # The spreadsheet rows are read as they are needed, and we want to remember
+    # our position in them as we inject in the commu groups, so we get
+    # an iterator and use the same iterator for all injections
+    # Returns the replacements to make in each commu line
+    # Reading the spreadsheet is part of this stage, since its rows
+    # are read as they are injected
+    line_replacements: list[list[tuple[int, int, str]]] = [
+        [] for _ in parsed_commu.commu_lines
+    ]
+    with (
+        measure_stage(stats, "read spreadsheet and inject"),
+        closing(
+            get_file_format(format_name).iter_tl_lines(xlsx_path, "Sheet1")
+        ) as tl_lines,
+    ):
+        tl_lines_iterator = enumerate(tl_lines)
+        for line_number, dialogue_row in parsed_commu.dialogue_rows:
+            inject_tl_line(
+                dialogue_row,
+                line_number,
+                tl_lines_iterator,
+                line_replacements[line_number - 1],
+            )
+    return line_replacements
 
-    # Read commu groups from the text file
-    with open(txt_path, "r", encoding="utf-8") as file:
-        groups = [CommuGroup.from_commu_line(line) for line in file]
 
-    # Inject translations into the commu groups
-    # We want to remember our position in the list of translated lines
-    # as we inject in the commu groups, so we get an iterator
-    # and use the same iterator for all injections
-    tl_lines_iterator = enumerate(tl_lines).__iter__()
-    for index, group in enumerate(groups):
-        inject_tl_lines(group, index + 1, tl_lines_iterator)
+def write_injected_lines(
+    commu_lines: list[str],
+    line_replacements: list[list[tuple[int, int, str]]],
+    output_path,
+    stats: FileStats | None = None,
+):
+    # Only the names and texts are replaced, the rest of each line
+    # is copied over unchanged
+    with measure_stage(stats, "write output"):
+        output_lines = [
+            splice_line(commu_line, replacements)
+            for commu_line, replacements in zip(commu_lines, line_replacements)
+        ]
 
-    # Write the modified commu groups to the output file
-    with open(output_path, "w", encoding="utf-8") as file:
-        file.write("\n".join([str(group) for group in groups]))
-        file.write("\n")
+        # Write the modified commu lines to the output file
+        with open(output_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(output_lines))
+            file.write("\n")
+
+
+def inject_translations(
+    txt_path,
+    xlsx_path,
+    output_path,
+    cache: ParseCache | None = None,
+    stats: FileStats | None = None,
+    format_name: str = "xlsx",
+):
+    parsed_commu = parse_commu_for_injection(txt_path, cache, stats)
+    line_replacements = inject_spreadsheet(parsed_commu, xlsx_path, stats, format_name)
+    write_injected_lines(
+        parsed_commu.commu_lines, line_replacements, output_path, stats
+    )
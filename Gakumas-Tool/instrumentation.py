@@ -0,0 +1,211 @@
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Records how long each stage of processing a file takes, so slow runs
+# can be compared stage by stage
+# In memory accounting mode, it also records the peak memory allocated
+# by python during each stage (traced by tracemalloc), and the resident set size
+# of the process at the end of each stage
+# FileStats only holds plain values, so it can be returned from
+# the processes of a pool
+
+
+def get_rss_bytes() -> int | None:
+    # The current resident set size on Linux, otherwise the largest one so far
+    # where the resource module exists, and None on Windows
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB everywhere else
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class FileStats:
+    file_path: str
+    is_successful: bool
+    stage_seconds: dict[str, float]
+    counts: dict[str, int]
+    measures_memory: bool
+    stage_peak_traced_bytes: dict[str, int]
+    stage_rss_bytes: dict[str, int]
+
+    def __init__(self, file_path: str, measures_memory: bool = False):
+        self.file_path = file_path
+        self.is_successful = False
+        self.stage_seconds = {}
+        self.counts = {}
+        self.measures_memory = measures_memory
+        self.stage_peak_traced_bytes = {}
+        self.stage_rss_bytes = {}
+        # Tracing stays on for the rest of the process once it's started,
+        # since it only counts allocations made after it starts
+        if measures_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, stage_name: str):
+        # Adds the time taken by the body of the with statement to the stage
+        # (and records its peak memory use, in memory accounting mode)
+        if self.measures_memory:
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage_name] = (
+                self.stage_seconds.get(stage_name, 0) + time.perf_counter() - start_time
+            )
+            if self.measures_memory:
+                self.record_memory(stage_name)
+
+    def record_memory(self, stage_name: str):
+        _, peak_traced_bytes = tracemalloc.get_traced_memory()
+        self.stage_peak_traced_bytes[stage_name] = max(
+            self.stage_peak_traced_bytes.get(stage_name, 0), peak_traced_bytes
+        )
+        rss_bytes = get_rss_bytes()
+        if rss_bytes is not None:
+            self.stage_rss_bytes[stage_name] = max(
+                self.stage_rss_bytes.get(stage_name, 0), rss_bytes
+            )
+
+    def get_peak_traced_bytes(self):
+        return max(self.stage_peak_traced_bytes.values(), default=0)
+
+    def get_peak_rss_bytes(self):
+        return max(self.stage_rss_bytes.values(), default=0)
+
+    def add_count(self, count_name: str, count: int):
+        self.counts[count_name] = self.counts.get(count_name, 0) + count
+
+    def get_total_seconds(self):
+        return sum(self.stage_seconds.values())
+
+    def to_dict(self):
+        return {
+            "file_path": self.file_path,
+            "is_successful": self.is_successful,
+            "total_seconds": self.get_total_seconds(),
+            "stage_seconds": self.stage_seconds,
+            "counts": self.counts,
+        } | (
+            {
+                "peak_traced_bytes": self.get_peak_traced_bytes(),
+                "peak_rss_bytes": self.get_peak_rss_bytes(),
+                "stage_peak_traced_bytes": self.stage_peak_traced_bytes,
+                "stage_rss_bytes": self.stage_rss_bytes,
+            }
+            if self.measures_memory
+            else {}
+        )
+
+
+def measure_stage(stats: FileStats | None, stage_name: str):
+    # Lets functions be timed only when they are given stats to record into
+    return nullcontext() if stats is None else stats.stage(stage_name)
+
+
+def add_count(stats: FileStats | None, count_name: str, count: int):
+    if stats is not None:
+        stats.add_count(count_name, count)
+
+
+def get_slowest_file_stats(file_stats_list: list[FileStats], count: int):
+    return sorted(
+        file_stats_list,
+        key=lambda file_stats: file_stats.get_total_seconds(),
+        reverse=True,
+    )[:count]
+
+
+def get_stage_totals(file_stats_list: list[FileStats]) -> dict[str, float]:
+    stage_totals = {}
+    for file_stats in file_stats_list:
+        for stage_name, seconds in file_stats.stage_seconds.items():
+            stage_totals[stage_name] = stage_totals.get(stage_name, 0) + seconds
+    return stage_totals
+
+
+def print_largest_memory_peaks(file_stats_list: list[FileStats], count: int = 5):
+    largest_file_stats = sorted(
+        file_stats_list,
+        key=lambda file_stats: file_stats.get_peak_traced_bytes(),
+        reverse=True,
+    )[:count]
+    if not largest_file_stats:
+        return
+    print("Largest memory peaks (traced, RSS):")
+    for file_stats in largest_file_stats:
+        stage_peaks = ", ".join(
+            f"{stage_name} {peak_traced_bytes / 2**20:.1f} MiB"
+            for stage_name, peak_traced_bytes in file_stats.stage_peak_traced_bytes.items()
+        )
+        print(
+            f"  {file_stats.file_path}: "
+            + f"{file_stats.get_peak_traced_bytes() / 2**20:.1f} MiB, "
+            + f"{file_stats.get_peak_rss_bytes() / 2**20:.1f} MiB ({stage_peaks})"
+        )
+
+
+def print_slowest_files(file_stats_list: list[FileStats], count: int = 5):
+    slowest_file_stats = get_slowest_file_stats(file_stats_list, count)
+    if not slowest_file_stats:
+        return
+    print("Slowest files:")
+    for file_stats in slowest_file_stats:
+        stage_times = ", ".join(
+            f"{stage_name} {seconds:.3f}s"
+            for stage_name, seconds in file_stats.stage_seconds.items()
+        )
+        print(
+            f"  {file_stats.file_path}: {file_stats.get_total_seconds():.3f}s"
+            + f" ({stage_times})"
+        )
+
+
+def write_report(
+    report_path: str,
+    command: str,
+    file_stats_list: list[FileStats],
+    total_seconds: float,
+):
+    # .jsonl reports have a line for each file followed by a summary line,
+    # other reports are a single json object
+    summary = {
+        "command": command,
+        "total_seconds": total_seconds,
+        "file_count": len(file_stats_list),
+        "stage_seconds": get_stage_totals(file_stats_list),
+        "slowest_files": [
+            file_stats.file_path
+            for file_stats in get_slowest_file_stats(file_stats_list, 10)
+        ],
+    }
+    if any(file_stats.measures_memory for file_stats in file_stats_list):
+        summary["peak_traced_bytes"] = max(
+            file_stats.get_peak_traced_bytes() for file_stats in file_stats_list
+        )
+        summary["peak_rss_bytes"] = max(
+            file_stats.get_peak_rss_bytes() for file_stats in file_stats_list
+        )
+    with open(report_path, "w", encoding="utf-8") as file:
+        if report_path.endswith(".jsonl"):
+            for file_stats in file_stats_list:
+                file.write(json.dumps(file_stats.to_dict(), ensure_ascii=False))
+                file.write("\n")
+            file.write(json.dumps({"summary": summary}, ensure_ascii=False))
+            file.write("\n")
+        else:
+            report = summary | {
+                "files": [file_stats.to_dict() for file_stats in file_stats_list]
+            }
+            json.dump(report, file, ensure_ascii=False, indent=1)
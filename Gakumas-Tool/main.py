@@ -1,14 +1,113 @@
+import io
+import json
 import os
 import sys
 import time
 import argparse
-import tkinter as tk
 from collections import namedtuple
-from tkinter import filedialog
+from contextlib import redirect_stderr, redirect_stdout
+from functools import partial
 from traceback import TracebackException
-from extract_lines import extract_lines
-from save_to_excel import save_to_excel
-from inject_translations import inject_translations
+from instrumentation import (
+    FileStats,
+    print_largest_memory_peaks,
+    print_slowest_files,
+    write_report,
+)
+from manifest import FileManifest
+from parse_cache import ParseCache, cache_directory_name, parse_commu_file
+from save_to_excel import merge_with_spreadsheet, write_merged_spreadsheet
+from file_formats import file_formats, get_file_format, get_tl_lines
+from status_index import StatusIndex, TranslationCounts, add_counts
+from translation_memory import TranslationMemory
+from inject_translations import (
+    inject_spreadsheet,
+    parse_commu_for_injection,
+    write_injected_lines,
+)
+
+extract_manifest_file_name = ".extract-manifest.json"
+inject_manifest_file_name = ".inject-manifest.json"
+
+
+def non_negative_int(value: str):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is negative")
+    return number
+
+
+def add_jobs_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=non_negative_int,
+        default=1,
+        help="The number of files to process in parallel "
+        + "(default: 1, 0 uses every CPU core)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("process", "thread"),
+        default="process",
+        help="Processes files in a pool of processes (the default), "
+        + "or in a pipeline of threads with -j threads for each stage "
+        + "(parsing, reading spreadsheets and writing), "
+        + "which is only faster on a free-threaded build of python "
+        + "or with slow storage, and not expected to be faster otherwise",
+    )
+
+
+def add_format_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--format",
+        choices=list(file_formats),
+        default="xlsx",
+        help="The format of the translation files in xlsx_directory "
+        + "(default: xlsx)",
+    )
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser, txt_directory_argument):
+    parser.add_argument(
+        "--cache-dir",
+        help="The directory to cache parsed commu files in "
+        + f"(default: {cache_directory_name} in {txt_directory_argument})",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="The maximum size of the parse cache in MiB (default: 1024)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Parses every commu file without using the parse cache",
+    )
+
+
+def add_report_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--report",
+        metavar="REPORT_PATH",
+        help="Writes the time each stage took for each file to a json report "
+        + "(or a jsonl report with a line for each file, if the path ends "
+        + "with .jsonl), and lists the slowest files",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="STATS_PATH",
+        help="Profiles the run with cProfile, and writes the stats to the file "
+        + "(with -j, only the main process or thread is profiled)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Measures the peak memory allocated and the resident set size "
+        + "during each stage for each file, and lists the largest peaks "
+        + "(slows the run down)",
+    )
 
 
 def create_argument_parser():
@@ -32,7 +131,7 @@ def create_argument_parser():
         "-a",
         "--all",
         action="store_true",
-        help="Extracts data from all commu files, not just recently modified ones",
+        help="Extracts data from all commu files, not just changed ones",
     )
     parser_extract.add_argument(
         "-f",
@@ -40,6 +139,23 @@ def create_argument_parser():
         action="store_true",
         help="Overwrites xlsx files even if there is no change in the raw lines",
     )
+    parser_extract.add_argument(
+        "--align",
+        action="store_true",
+        help="Carries translations over to slightly edited lines, "
+        + "and highlights them for review",
+    )
+    parser_extract.add_argument(
+        "--tm",
+        metavar="DATABASE",
+        help="Fills in new rows with translations of the same lines "
+        + "from a translation memory database, "
+        + "and adds the translations of existing spreadsheets to it",
+    )
+    add_format_argument(parser_extract)
+    add_jobs_argument(parser_extract)
+    add_cache_arguments(parser_extract, "txt_directory")
+    add_report_arguments(parser_extract)
     parser_extract.set_defaults(func=generate_xlsx_files)
     parser_inject = subparsers.add_parser(
         "inject",
@@ -61,140 +177,574 @@ def create_argument_parser():
         "-a",
         "--all",
         action="store_true",
-        help="Injects data from all excel files, not just recently modified ones",
+        help="Injects data from all excel files, not just changed ones",
     )
+    add_format_argument(parser_inject)
+    add_jobs_argument(parser_inject)
+    add_cache_arguments(parser_inject, "in_txt_directory")
+    add_report_arguments(parser_inject)
     parser_inject.set_defaults(func=inject_tl_files)
+    parser_import_tm = subparsers.add_parser(
+        "import-tm",
+        help="Adds the translations of the spreadsheets in xlsx_directory "
+        + "to a translation memory database",
+    )
+    parser_import_tm.add_argument(
+        "xlsx_directory",
+        help="The directory containing the spreadsheets with translated data",
+    )
+    parser_import_tm.add_argument(
+        "database", help="The translation memory database (created if missing)"
+    )
+    add_format_argument(parser_import_tm)
+    parser_import_tm.set_defaults(func=import_translation_memory)
+    parser_convert = subparsers.add_parser(
+        "convert",
+        help="Converts the translation files in input_directory "
+        + "to another format in output_directory",
+    )
+    parser_convert.add_argument(
+        "input_directory", help="The directory containing the translation files"
+    )
+    parser_convert.add_argument(
+        "output_directory", help="The directory to hold the converted files"
+    )
+    parser_convert.add_argument(
+        "--from",
+        dest="from_format",
+        choices=list(file_formats),
+        default="xlsx",
+        help="The format of the files to convert (default: xlsx)",
+    )
+    parser_convert.add_argument(
+        "--to",
+        dest="to_format",
+        choices=list(file_formats),
+        required=True,
+        help="The format to convert the files to",
+    )
+    parser_convert.set_defaults(func=convert_files)
+    parser_status = subparsers.add_parser(
+        "status",
+        help="Reports how many rows of the spreadsheets in xlsx_directory "
+        + "are translated",
+    )
+    parser_status.add_argument(
+        "xlsx_directory",
+        help="The directory containing the spreadsheets with translated data",
+    )
+    add_format_argument(parser_status)
+    parser_status.add_argument(
+        "--json",
+        action="store_true",
+        help="Prints the counts of each file and the totals as json",
+    )
+    parser_status.set_defaults(func=print_translation_status)
     return parser
 
 
-def generate_xlsx(input_path, output_path, force_overwrite):
+# Extracting and injecting are each split into three stages (parsing,
+# reading and merging the spreadsheet, and writing the output),
+# which run one after another for each file, except with the thread backend,
+# where they run in a pipeline
+# Each stage passes on the stats of the file and what the next stage needs,
+# or None for the latter once there's nothing left to do for the file
+# The stats of the file record whether it succeeded
+
+
+def print_file_error(message, e: Exception):
+    print(message, file=sys.stderr)
+    TracebackException.from_exception(e).print()
+
+
+def parse_commu_to_extract(input_path, output_path, cache=None, measures_memory=False):
+    stats = FileStats(input_path, measures_memory)
     try:
-        raw_data_rows = extract_lines(input_path)
+        # Every line that fails to parse is reported,
+        # but the spreadsheet is only written if all of them parse
+        parse_errors = []
+        with stats.stage("parse"):
+            parsed_commu = parse_commu_file(input_path, parse_errors, cache)
+        stats.add_count("commu lines", len(parsed_commu.commu_lines))
+        raw_data_rows = [
+            dialogue_row.raw_line for _, dialogue_row in parsed_commu.dialogue_rows
+        ]
+        if parse_errors:
+            print(f"Error generating xlsx for {input_path}:", file=sys.stderr)
+            for line_number, message in parse_errors:
+                print(f"Line {line_number}: {message}", file=sys.stderr)
+            return stats, output_path, None
         if not raw_data_rows:
             print(f"No valid lines found in {input_path}. Skipping...")
-        else:
-            save_to_excel(raw_data_rows, output_path, "Sheet1", force_overwrite)
-        return True
+            stats.is_successful = True
+            return stats, output_path, None
+        return stats, output_path, raw_data_rows
+    except Exception as e:
+        print_file_error(f"Error generating xlsx for {input_path}:", e)
+        return stats, output_path, None
+
+
+def merge_extracted_lines(
+    parse_result, force_overwrite, align=False, tm_path=None, format_name="xlsx"
+):
+    stats, output_path, raw_data_rows = parse_result
+    if raw_data_rows is None:
+        return stats, output_path, None
+    # Each file opens the translation memory itself,
+    # since connections can't be shared between processes or threads
+    memory = TranslationMemory(tm_path) if tm_path is not None else None
+    try:
+        merged = merge_with_spreadsheet(
+            raw_data_rows,
+            output_path,
+            "Sheet1",
+            force_overwrite,
+            align,
+            memory,
+            stats,
+            format_name,
+        )
+        if merged is None:
+            stats.is_successful = True
+        return stats, output_path, merged
     except Exception as e:
-        print(f"Error generating xlsx for {input_path}:", file=sys.stderr)
-        TracebackException.from_exception(e).print()
-        return False
+        print_file_error(f"Error generating xlsx for {stats.file_path}:", e)
+        return stats, output_path, None
+    finally:
+        if memory is not None:
+            memory.close()
 
 
-def inject_tl(txt_path, xlsx_path, output_path):
+def write_extracted_lines(merge_result, format_name="xlsx"):
+    stats, output_path, merged = merge_result
+    if merged is None:
+        return stats
     try:
-        inject_translations(txt_path, xlsx_path, output_path)
-        print(f"{txt_path} processed")
-        return True
+        write_merged_spreadsheet(merged, output_path, "Sheet1", stats, format_name)
+        stats.is_successful = True
     except Exception as e:
-        print(f"Error injecting into {txt_path}:", file=sys.stderr)
-        TracebackException.from_exception(e).print()
-        return False
+        print_file_error(f"Error generating xlsx for {stats.file_path}:", e)
+    return stats
 
 
-def get_lastrun_time(directory):
-    lastrun_filename = os.path.join(directory, ".lastrun")
-    if os.path.exists(lastrun_filename):
-        return os.stat(lastrun_filename).st_mtime
-    else:
-        return None
+def parse_commu_to_inject(
+    txt_path, xlsx_path, output_path, cache=None, measures_memory=False
+):
+    stats = FileStats(txt_path, measures_memory)
+    try:
+        parsed_commu = parse_commu_for_injection(txt_path, cache, stats)
+        return stats, xlsx_path, output_path, parsed_commu
+    except Exception as e:
+        print_file_error(f"Error injecting into {txt_path}:", e)
+        return stats, xlsx_path, output_path, None
 
 
-def set_lastrun_time(directory):
-    lastrun_filename = os.path.join(directory, ".lastrun")
-    with open(lastrun_filename, "w"):
-        pass
+def inject_spreadsheet_lines(parse_result, format_name="xlsx"):
+    stats, xlsx_path, output_path, parsed_commu = parse_result
+    if parsed_commu is None:
+        return stats, output_path, None
+    try:
+        line_replacements = inject_spreadsheet(
+            parsed_commu, xlsx_path, stats, format_name
+        )
+        return stats, output_path, (parsed_commu.commu_lines, line_replacements)
+    except Exception as e:
+        print_file_error(f"Error injecting into {stats.file_path}:", e)
+        return stats, output_path, None
+
+
+def write_injected_commu(inject_result):
+    stats, output_path, injected_lines = inject_result
+    if injected_lines is None:
+        return stats
+    try:
+        commu_lines, line_replacements = injected_lines
+        write_injected_lines(commu_lines, line_replacements, output_path, stats)
+        print(f"{stats.file_path} processed")
+        stats.is_successful = True
+    except Exception as e:
+        print_file_error(f"Error injecting into {stats.file_path}:", e)
+    return stats
+
+
+def run_stages(stages, *path_tuple):
+    # Runs the stages for one file, one after another
+    result = stages[0](*path_tuple)
+    for stage in stages[1:]:
+        result = stage(result)
+    return result
+
+
+def run_with_captured_output(function, *args):
+    # Runs the function with everything it prints captured,
+    # so the output of files processed in parallel can be printed in order
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        result = function(*args)
+    return result, stdout.getvalue(), stderr.getvalue()
+
+
+def iter_file_jobs(stages, path_tuples, jobs: int, backend: str = "process"):
+    # Runs the stages on each tuple of paths, and yields the results in order
+    # With more than one job, the files are processed in a pool of processes,
+    # and the output for each file is printed in the same order as the paths
+    # With the thread backend, the stages run in a pipeline of threads instead,
+    # with jobs threads for each stage
+    if backend == "thread":
+        from pipeline import run_pipeline
+
+        yield from run_pipeline(stages, path_tuples, jobs or os.cpu_count() or 1)
+        return
+    function = partial(run_stages, stages)
+    if jobs == 1:
+        for path_tuple in path_tuples:
+            yield function(*path_tuple)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    executor = ProcessPoolExecutor(max_workers=jobs or None)
+    try:
+        futures = [
+            executor.submit(run_with_captured_output, function, *path_tuple)
+            for path_tuple in path_tuples
+        ]
+        for future in futures:
+            result, stdout_text, stderr_text = future.result()
+            print(stdout_text, end="")
+            print(stderr_text, end="", file=sys.stderr)
+            yield result
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+# How many processed files to record before saving the manifest again
+manifest_save_interval = 20
+
+
+def process_files(
+    stages, path_tuples, tracked_path_index, manifest: FileManifest, args
+):
+    # Processes the files that changed or failed since the last run
+    # (or every file with -a), where the file that is checked for changes
+    # is path_tuple[tracked_path_index]
+    # The results are recorded in the manifest as files finish,
+    # so an interrupted run carries on from where it stopped
+    # Returns the files that failed, and the stats of the processed files
+    tracked_paths = [path_tuple[tracked_path_index] for path_tuple in path_tuples]
+    for file_name in manifest.remove_missing(tracked_paths):
+        print(f"{file_name} has been removed since the last run")
+
+    paths_to_process = []
+    file_states = []
+    for path_tuple, tracked_path in zip(path_tuples, tracked_paths):
+        needs_processing, file_state = manifest.check_file(tracked_path)
+        if needs_processing or args["all"]:
+            paths_to_process.append(path_tuple)
+            file_states.append(file_state)
+
+    failed_paths = []
+    file_stats_list = []
+    try:
+        results = iter_file_jobs(
+            stages, paths_to_process, args["jobs"], args["backend"]
+        )
+        for index, (path_tuple, file_state, file_stats) in enumerate(
+            zip(paths_to_process, file_states, results)
+        ):
+            tracked_path = path_tuple[tracked_path_index]
+            manifest.record(tracked_path, file_state, file_stats.is_successful)
+            file_stats_list.append(file_stats)
+            if not file_stats.is_successful:
+                failed_paths.append(tracked_path)
+            if (index + 1) % manifest_save_interval == 0:
+                manifest.save()
+    finally:
+        manifest.save()
+    return failed_paths, file_stats_list
+
+
+def print_failed_paths(failed_paths, path_count):
+    print(f"{len(failed_paths)} of {path_count} files failed:")
+    for path in failed_paths:
+        print(f"  {path}")
+
+
+def report_file_stats(args, command, file_stats_list, total_seconds):
+    if args["memory"]:
+        print_largest_memory_peaks(file_stats_list)
+    report_path = args["report"]
+    if report_path is None:
+        return
+    print_slowest_files(file_stats_list)
+    write_report(report_path, command, file_stats_list, total_seconds)
+    print(f"Wrote the report to {report_path}")
+
+
+def create_parse_cache(args, txt_directory):
+    if args["no_cache"]:
+        return None
+    cache_directory = args["cache_dir"] or os.path.join(
+        txt_directory, cache_directory_name
+    )
+    return ParseCache(cache_directory, args["cache_size"] * 1024 * 1024)
 
 
 def generate_xlsx_files(args):
     txt_directory = args["txt_directory"]
     xlsx_directory = args["xlsx_directory"]
+    extension = get_file_format(args["format"]).extension
     Path_pair = namedtuple("Path_pair", ["input_path", "output_path"])
     paths = (
         Path_pair(
             os.path.join(txt_directory, file_name),
-            os.path.join(xlsx_directory, os.path.splitext(file_name)[0] + ".xlsx"),
+            os.path.join(xlsx_directory, os.path.splitext(file_name)[0] + extension),
         )
-        for file_name in os.listdir(txt_directory)
+        for file_name in sorted(os.listdir(txt_directory))
         if file_name.startswith("adv") and file_name.endswith(".txt")
     )
 
-    # Filter out the txt files that were last modified before
-    # the last run time
-    lastrun_time = get_lastrun_time(txt_directory)
-    if lastrun_time is not None and not args["all"]:
-        paths = (
-            path_tuple
-            for path_tuple in paths
-            if os.stat(path_tuple[0]).st_mtime > lastrun_time
-        )
-
+    cache = create_parse_cache(args, txt_directory)
     start_time = time.perf_counter()
-    is_successful = all(
-        generate_xlsx(path_tuple.input_path, path_tuple.output_path, args["force"])
-        for path_tuple in paths
+    failed_paths, file_stats_list = process_files(
+        [
+            partial(
+                parse_commu_to_extract,
+                cache=cache,
+                measures_memory=args["memory"],
+            ),
+            partial(
+                merge_extracted_lines,
+                force_overwrite=args["force"],
+                align=args["align"],
+                tm_path=args["tm"],
+                format_name=args["format"],
+            ),
+            partial(write_extracted_lines, format_name=args["format"]),
+        ],
+        list(paths),
+        0,
+        FileManifest(txt_directory, extract_manifest_file_name),
+        args,
     )
     end_time = time.perf_counter()
+    if cache is not None:
+        cache.evict()
 
-    if is_successful:
-        set_lastrun_time(txt_directory)
-        print("Conversion to .xlsx completed successfully.")
+    if not failed_paths:
+        print(f"Conversion to {extension} completed successfully.")
         print(f"Time taken: {end_time - start_time} seconds")
     else:
         print("Data extraction had some errors.")
+        print_failed_paths(failed_paths, len(file_stats_list))
+    report_file_stats(args, "extract", file_stats_list, end_time - start_time)
 
 
 def inject_tl_files(args):
     in_txt_directory = args["in_txt_directory"]
     xlsx_directory = args["xlsx_directory"]
     out_txt_directory = args["out_txt_directory"]
+    extension = get_file_format(args["format"]).extension
     paths = (
         (
             os.path.join(in_txt_directory, file_name),
-            os.path.join(xlsx_directory, os.path.splitext(file_name)[0] + ".xlsx"),
+            os.path.join(xlsx_directory, os.path.splitext(file_name)[0] + extension),
             os.path.join(out_txt_directory, file_name),
         )
-        for file_name in os.listdir(in_txt_directory)
+        for file_name in sorted(os.listdir(in_txt_directory))
         if file_name.endswith(".txt")
     )
 
     # Filter out tuples where the xlsx file doesn't exist
     paths = (path_tuple for path_tuple in paths if os.path.exists(path_tuple[1]))
 
-    # Filter out the xlsx files that were last modified before
-    # the last run time
-    lastrun_time = get_lastrun_time(xlsx_directory)
-    if lastrun_time is not None and not args["all"]:
-        paths = (
-            path_tuple
-            for path_tuple in paths
-            if os.stat(path_tuple[1]).st_mtime > lastrun_time
-        )
-
+    cache = create_parse_cache(args, in_txt_directory)
     start_time = time.perf_counter()
-    is_successful = all(inject_tl(*path_tuple) for path_tuple in paths)
+    failed_paths, file_stats_list = process_files(
+        [
+            partial(parse_commu_to_inject, cache=cache, measures_memory=args["memory"]),
+            partial(inject_spreadsheet_lines, format_name=args["format"]),
+            write_injected_commu,
+        ],
+        list(paths),
+        1,
+        FileManifest(xlsx_directory, inject_manifest_file_name),
+        args,
+    )
     end_time = time.perf_counter()
+    if cache is not None:
+        cache.evict()
 
-    if is_successful:
-        set_lastrun_time(xlsx_directory)
+    if not failed_paths:
         print("Translation injection completed successfully.")
         print(f"Time taken: {end_time - start_time} seconds")
     else:
         print("Data injection had some errors.")
+        print_failed_paths(failed_paths, len(file_stats_list))
+    report_file_stats(args, "inject", file_stats_list, end_time - start_time)
 
 
-def main():
-    root = tk.Tk()
-    root.withdraw()
+def import_translation_memory(args):
+    xlsx_directory = args["xlsx_directory"]
+    extension = get_file_format(args["format"]).extension
+    memory = TranslationMemory(args["database"])
+    failed_paths = []
+    path_count = 0
+    try:
+        for file_name in sorted(os.listdir(xlsx_directory)):
+            if not file_name.endswith(extension):
+                continue
+            xlsx_path = os.path.join(xlsx_directory, file_name)
+            path_count += 1
+            try:
+                memory.add_tl_lines(get_tl_lines(xlsx_path, "Sheet1", args["format"]))
+            except Exception as e:
+                print(f"Error reading {xlsx_path}:", file=sys.stderr)
+                TracebackException.from_exception(e).print()
+                failed_paths.append(xlsx_path)
+    finally:
+        memory.close()
+
+    if not failed_paths:
+        print(f"Added the translations of {path_count} spreadsheets.")
+    else:
+        print("Adding translations had some errors.")
+        print_failed_paths(failed_paths, path_count)
+
+
+def convert_files(args):
+    input_directory = args["input_directory"]
+    output_directory = args["output_directory"]
+    input_format = get_file_format(args["from_format"])
+    output_format = get_file_format(args["to_format"])
+    os.makedirs(output_directory, exist_ok=True)
+    failed_paths = []
+    path_count = 0
+    for file_name in sorted(os.listdir(input_directory)):
+        if not file_name.endswith(input_format.extension):
+            continue
+        input_path = os.path.join(input_directory, file_name)
+        output_path = os.path.join(
+            output_directory, os.path.splitext(file_name)[0] + output_format.extension
+        )
+        path_count += 1
+        try:
+            output_format.write_tl_lines(
+                get_tl_lines(input_path, "Sheet1", args["from_format"]),
+                output_path,
+                "Sheet1",
+                set(),
+            )
+        except Exception as e:
+            print_file_error(f"Error converting {input_path}:", e)
+            failed_paths.append(input_path)
+
+    if not failed_paths:
+        print(f"Converted {path_count} files to {output_format.extension}.")
+    else:
+        print("Conversion had some errors.")
+        print_failed_paths(failed_paths, path_count)
+
+
+def format_counts(counts: TranslationCounts):
+    row_count = counts.translated_rows + counts.untranslated_rows
+    char_count = counts.translated_chars + counts.untranslated_chars
+    percentage = 100 * counts.translated_rows / row_count if row_count else 100
+    return (
+        f"{counts.translated_rows:,}/{row_count:,} rows translated "
+        + f"({percentage:.1f}%), "
+        + f"{counts.translated_chars:,}/{char_count:,} chars translated"
+    )
+
+
+# How many files to read before saving the status index again
+# Files are counted faster than they are extracted, so this is larger
+# than manifest_save_interval
+status_index_save_interval = 100
+
 
+def print_translation_status(args):
+    # The counts of files that haven't changed since the last status
+    # are taken from the index instead of reading the files again
+    xlsx_directory = args["xlsx_directory"]
+    extension = get_file_format(args["format"]).extension
+    file_names = sorted(os.listdir(xlsx_directory))
+    status_index = StatusIndex(xlsx_directory)
+    status_index.remove_missing(file_names)
+    file_counts = {}
+    failed_paths = []
+    read_count = 0
+    try:
+        for file_name in file_names:
+            if not file_name.endswith(extension):
+                continue
+            file_path = os.path.join(xlsx_directory, file_name)
+            try:
+                counts, was_read = status_index.get_counts(file_path, args["format"])
+            except Exception as e:
+                print_file_error(f"Error reading {file_path}:", e)
+                failed_paths.append(file_path)
+                continue
+            file_counts[file_name] = counts
+            if was_read:
+                read_count += 1
+                # Keep the counts read so far if the status is interrupted
+                if read_count % status_index_save_interval == 0:
+                    status_index.save()
+    finally:
+        status_index.save()
+
+    total_counts = TranslationCounts(0, 0, 0, 0)
+    for counts in file_counts.values():
+        total_counts = add_counts(total_counts, counts)
+    if args["json"]:
+        status = {
+            "files": {
+                file_name: counts._asdict() for file_name, counts in file_counts.items()
+            },
+            "total": total_counts._asdict(),
+        }
+        print(json.dumps(status, ensure_ascii=False, indent=1))
+    else:
+        for file_name, counts in file_counts.items():
+            print(f"{file_name}: {format_counts(counts)}")
+        print(f"Total: {format_counts(total_counts)}")
+        print(
+            f"Read {read_count} of {len(file_counts)} files "
+            + "(the others haven't changed since the last status)"
+        )
+    if failed_paths:
+        print_failed_paths(failed_paths, len(file_counts) + len(failed_paths))
+
+
+def main():
     parser = create_argument_parser()
     args = parser.parse_args(sys.argv[1:])
+    # tracemalloc's peaks are shared by every thread, so they can't be
+    # told apart by file or stage when the stages run on threads
+    if getattr(args, "memory", False) and args.backend == "thread":
+        parser.error("--memory can't be used with --backend thread")
     if "func" in args:
         # subcommand has been selected, execute the function stored in func
-        args.func(vars(args))
+        if getattr(args, "profile", None) is not None:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.runcall(args.func, vars(args))
+            profiler.dump_stats(args.profile)
+            print(f"Wrote the profile stats to {args.profile}")
+        else:
+            args.func(vars(args))
         return
 
     # otherwise use the interactive behaviour
+    # tkinter is only needed (and a display is only needed) for the folder
+    # dialogs, so subcommands don't import it or create a window
+    import tkinter as tk
+    from tkinter import filedialog
+
+    root = tk.Tk()
+    root.withdraw()
     while True:
         try:
             option = input(
@@ -218,8 +768,9 @@ def main():
                 if not output_folder:
                     raise Exception("No output folder selected.")
 
+                # Use the same defaults for the options as the subcommand
                 generate_xlsx_files(
-                    {"txt_directory": input_folder, "xlsx_directory": output_folder}
+                    vars(parser.parse_args(["extract", input_folder, output_folder]))
                 )
 
             elif option == "2":
@@ -242,11 +793,11 @@ def main():
                     raise Exception("No output folder selected.")
 
                 inject_tl_files(
-                    {
-                        "in_txt_directory": input_folder,
-                        "xlsx_directory": xlsx_folder,
-                        "out_txt_directory": output_folder,
-                    }
+                    vars(
+                        parser.parse_args(
+                            ["inject", input_folder, xlsx_folder, output_folder]
+                        )
+                    )
                 )
 
             elif option == "3":
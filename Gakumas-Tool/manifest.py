@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import sys
+from typing import NamedTuple
+from atomic_write import write_json_atomically
+
+# The marker file used before the manifest, which only had the time
+# of the last successful run of the whole directory
+legacy_lastrun_file_name = ".lastrun"
+manifest_version = 1
+
+
+class FileState(NamedTuple):
+    size: int
+    mtime_ns: int
+    sha256: str
+
+
+def hash_file(file_path: str):
+    with open(file_path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def get_file_state(file_path: str):
+    file_stat = os.stat(file_path)
+    return FileState(file_stat.st_size, file_stat.st_mtime_ns, hash_file(file_path))
+
+
+def remove_missing_entries(entries: dict[str, dict], file_paths: list[str]):
+    # Removes the entries of files that aren't in file_paths,
+    # and returns their names
+    existing_file_names = set(os.path.basename(path) for path in file_paths)
+    missing_file_names = sorted(
+        file_name for file_name in entries if file_name not in existing_file_names
+    )
+    for file_name in missing_file_names:
+        del entries[file_name]
+    return missing_file_names
+
+
+class FileManifest:
+    # Remembers the state of each file in a directory when it was last
+    # processed, and whether processing it succeeded, so only files that
+    # changed or failed are processed again
+    # Files whose size and modification time haven't changed are assumed
+    # to be unchanged, otherwise their content hash is compared, so touching
+    # or checking out a file doesn't make it look new
+    directory: str
+    entries: dict[str, dict]
+
+    def __init__(self, directory: str, manifest_file_name: str):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, manifest_file_name)
+        self.entries = {}
+        self.legacy_lastrun_time_ns = None
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+            if manifest.get("version") == manifest_version:
+                self.entries = manifest["files"]
+            return
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError, KeyError):
+            # A broken manifest is treated as missing, and replaced when saved
+            print(
+                f"Warning: ignoring unreadable manifest {self.manifest_path}",
+                file=sys.stderr,
+            )
+        # Files that weren't modified since the last run time of the old
+        # marker are treated as processed, so the first run is not a full run
+        lastrun_path = os.path.join(directory, legacy_lastrun_file_name)
+        if os.path.exists(lastrun_path):
+            self.legacy_lastrun_time_ns = os.stat(lastrun_path).st_mtime_ns
+
+    def check_file(self, file_path: str) -> tuple[bool, FileState]:
+        # Returns whether the file needs to be processed, and its current state
+        file_name = os.path.basename(file_path)
+        entry = self.entries.get(file_name)
+        file_stat = os.stat(file_path)
+        if entry is None and self.legacy_lastrun_time_ns is not None:
+            file_state = get_file_state(file_path)
+            if file_stat.st_mtime_ns <= self.legacy_lastrun_time_ns:
+                self.record(file_path, file_state, True)
+                return False, file_state
+            return True, file_state
+        if (
+            entry is None
+            or entry["status"] != "ok"
+            or entry["size"] != file_stat.st_size
+        ):
+            return True, get_file_state(file_path)
+
+        recorded_state = FileState(entry["size"], entry["mtime_ns"], entry["sha256"])
+        if file_stat.st_mtime_ns == recorded_state.mtime_ns:
+            return False, recorded_state
+        file_state = get_file_state(file_path)
+        if file_state.sha256 != recorded_state.sha256:
+            return True, file_state
+        # The content is the same, so remember the new modification time
+        # to avoid hashing the file again next time
+        self.record(file_path, file_state, True)
+        return False, file_state
+
+    def record(self, file_path: str, file_state: FileState, is_successful: bool):
+        self.entries[os.path.basename(file_path)] = {
+            "size": file_state.size,
+            "mtime_ns": file_state.mtime_ns,
+            "sha256": file_state.sha256,
+            "status": "ok" if is_successful else "failed",
+        }
+
+    def remove_missing(self, file_paths: list[str]) -> list[str]:
+        # Forgets the files that are no longer in the directory,
+        # and returns their names
+        return remove_missing_entries(self.entries, file_paths)
+
+    def save(self):
+        write_json_atomically(
+            self.manifest_path,
+            {"version": manifest_version, "files": self.entries},
+            ensure_ascii=False,
+            indent=1,
+            sort_keys=True,
+        )
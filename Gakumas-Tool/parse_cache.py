@@ -0,0 +1,184 @@
+import hashlib
+import io
+import json
+import os
+from typing import NamedTuple
+from atomic_write import write_file_atomically
+from data_types import DialogueRow, LineParseError, RawLine
+from extract_lines import create_dialogue_rows, iter_commu_groups
+
+# Cache entries made by a different version of the parser are never used,
+# so this must be increased whenever parsing or extraction changes
+# what is stored in the cache
+parser_version = 2
+
+cache_directory_name = ".parsecache"
+# The entries are json, which only holds data, since the cache directory
+# is inside the commu directory by default, and may come from someone else
+entry_extension = ".json"
+default_max_cache_size = 1024 * 1024 * 1024  # 1 GiB
+
+
+class ParsedCommu(NamedTuple):
+    # The stripped lines of the commu file
+    commu_lines: list[str]
+    # The rows extracted from the lines, with their line numbers
+    # These have everything extraction and injection need from the groups,
+    # so the groups themselves are not kept
+    dialogue_rows: list[tuple[int, DialogueRow]]
+
+
+def get_content_hash(content: bytes):
+    return hashlib.sha256(content).hexdigest()
+
+
+def to_cache_row(line_number: int, dialogue_row: DialogueRow):
+    return [line_number, *dialogue_row.raw_line, *dialogue_row[1:]]
+
+
+def is_span_list(value):
+    return isinstance(value, list) and all(
+        isinstance(span, list)
+        and len(span) == 2
+        and all(type(index) is int for index in span)
+        for span in value
+    )
+
+
+def check_cache_row(cache_row):
+    # Checks the types of the values, so a broken or crafted entry
+    # can't put anything but strings and spans in the rows
+    line_number, group_type, name, text, name_spans, text_spans = cache_row
+    if (
+        type(line_number) is not int
+        or not all(isinstance(value, str) for value in (group_type, name, text))
+        or not is_span_list(name_spans)
+        or not is_span_list(text_spans)
+    ):
+        raise ValueError("Invalid parse cache row")
+
+
+def from_cache_row(cache_row) -> tuple[int, DialogueRow]:
+    line_number, group_type, name, text, name_spans, text_spans = cache_row
+    return line_number, DialogueRow(
+        RawLine(group_type, name, text),
+        [tuple(span) for span in name_spans],
+        [tuple(span) for span in text_spans],
+    )
+
+
+class ParseCache:
+    # Stores the dialogue rows parsed from commu files on disk,
+    # keyed by the hash of the file content and the parser version,
+    # so unchanged commu files don't need to be parsed again
+    directory: str
+    max_size: int
+
+    def __init__(self, directory: str, max_size: int = default_max_cache_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_entry_path(self, content: bytes):
+        cache_key = get_content_hash(f"v{parser_version}:".encode() + content)
+        return os.path.join(self.directory, cache_key + entry_extension)
+
+    def load_rows(self, content: bytes) -> list[list] | None:
+        # Returns the rows as they are stored, as lists of the line number,
+        # group type, name, text, name spans and text spans
+        entry_path = self.get_entry_path(content)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as file:
+                cache_rows = json.load(file)
+            for cache_row in cache_rows:
+                check_cache_row(cache_row)
+            # Entries are evicted by least recent use, so mark it as used
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # A broken entry is treated as missing, and replaced when stored
+            return None
+        return cache_rows
+
+    def load(self, content: bytes) -> list[tuple[int, DialogueRow]] | None:
+        cache_rows = self.load_rows(content)
+        if cache_rows is None:
+            return None
+        return [from_cache_row(cache_row) for cache_row in cache_rows]
+
+    def store_rows(self, content: bytes, cache_rows: list[list]):
+        # Writes to a temporary file first, so other runs never read
+        # a partially written entry
+        # Like a broken entry when loading, failing to store an entry
+        # (e.g. a full disk, or another process reading it on Windows)
+        # only means the file isn't cached
+        try:
+            write_file_atomically(
+                self.get_entry_path(content),
+                lambda file: json.dump(
+                    cache_rows,
+                    file,
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                ),
+            )
+        except Exception:
+            pass
+
+    def store(self, content: bytes, dialogue_rows: list[tuple[int, DialogueRow]]):
+        self.store_rows(content, [to_cache_row(*row) for row in dialogue_rows])
+
+    def evict(self):
+        # Deletes the least recently used entries
+        # until the cache is no larger than max_size
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(entry_extension):
+                entry_stat = entry.stat()
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def read_commu_file(file_path) -> tuple[bytes, list[str]]:
+    # Returns the content of the file, to look it up in the cache,
+    # and its lines, decoded the same way as opening the file in text mode
+    with open(file_path, "rb") as file:
+        content = file.read()
+    with io.TextIOWrapper(io.BytesIO(content), encoding="utf-8") as text_file:
+        lines = text_file.readlines()
+    return content, lines
+
+
+def parse_commu_file(
+    file_path,
+    parse_errors: list[LineParseError] | None = None,
+    cache: ParseCache | None = None,
+) -> ParsedCommu:
+    content, lines = read_commu_file(file_path)
+    commu_lines = [line.strip() for line in lines]
+
+    dialogue_rows = cache.load(content) if cache is not None else None
+    if dialogue_rows is not None:
+        return ParsedCommu(commu_lines, dialogue_rows)
+
+    parsed_line_count = 0
+    dialogue_rows = []
+    for line_number, group in iter_commu_groups(lines, file_path, parse_errors):
+        parsed_line_count += 1
+        dialogue_rows.extend(
+            (line_number, dialogue_row) for dialogue_row in create_dialogue_rows(group)
+        )
+    # Files with lines that failed to parse are not cached,
+    # so their errors are reported again on the next run
+    if cache is not None and parsed_line_count == len(lines):
+        cache.store(content, dialogue_rows)
+    return ParsedCommu(commu_lines, dialogue_rows)
@@ -0,0 +1,188 @@
+import io
+import sys
+import threading
+from contextlib import redirect_stderr, redirect_stdout
+from queue import Queue
+
+# Runs files through a pipeline of stages on a pool of threads, where each stage
+# hands the files it has finished to the next one through a bounded queue,
+# so one file can be parsed while the spreadsheets of others are read or written
+# On a free-threaded build of python the stages run in parallel, and otherwise
+# they still overlap while waiting for files to be read and written,
+# which only makes up for switching between the threads on slow storage
+# Each file is only held by one stage at a time, and the stages don't share
+# any other mutable state, so they need no locks of their own
+
+
+class ThreadOutput:
+    # Stands in for sys.stdout or sys.stderr while the pipeline runs,
+    # and writes to the buffer of the file the current thread is working on,
+    # so the output of each file can be printed in order
+    # Threads that aren't working on a file write to the original stream
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def set_buffer(self, buffer: io.StringIO | None):
+        self.local.buffer = buffer
+
+    def write(self, text: str):
+        buffer = getattr(self.local, "buffer", None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class PipelineItem:
+    # A file going through the pipeline, with the result of the last stage
+    # that processed it, and everything the stages printed for it
+    def __init__(self, index: int, result):
+        self.index = index
+        self.result = result
+        self.error: BaseException | None = None
+        self.stdout = io.StringIO()
+        self.stderr = io.StringIO()
+
+
+# Put in a queue once for each thread reading from it, after the last file
+end_of_files = None
+
+
+class PipelineStage:
+    # The threads running one stage of the pipeline
+    # The last of them to finish tells the threads of the next stage to finish
+    def __init__(
+        self,
+        function,
+        thread_count: int,
+        input_queue: Queue,
+        output_queue: Queue,
+        next_thread_count: int,
+        stdout: ThreadOutput,
+        stderr: ThreadOutput,
+        cancelled: threading.Event,
+    ):
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.next_thread_count = next_thread_count
+        self.stdout = stdout
+        self.stderr = stderr
+        self.cancelled = cancelled
+        self.running_thread_count = thread_count
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True) for _ in range(thread_count)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        while (item := self.input_queue.get()) is not end_of_files:
+            # Files that failed with an unexpected error in an earlier stage
+            # are passed on, so the error is raised in order
+            if item.error is None and not self.cancelled.is_set():
+                self.stdout.set_buffer(item.stdout)
+                self.stderr.set_buffer(item.stderr)
+                try:
+                    item.result = self.function(item.result)
+                except BaseException as e:
+                    item.error = e
+                finally:
+                    self.stdout.set_buffer(None)
+                    self.stderr.set_buffer(None)
+            self.output_queue.put(item)
+        with self.lock:
+            self.running_thread_count -= 1
+            is_last_thread = self.running_thread_count == 0
+        if is_last_thread:
+            for _ in range(self.next_thread_count):
+                self.output_queue.put(end_of_files)
+
+
+def run_pipeline(stages, path_tuples, thread_count: int, queue_size: int = 0):
+    # Runs each tuple of paths through the stages, and yields the results
+    # in the same order as the paths
+    # The first stage is called with the paths, and each later stage
+    # with the result of the stage before it
+    # Each stage runs on thread_count threads, and each queue between stages
+    # holds at most queue_size files (thread_count by default)
+    # No more files are started than the queues and threads can hold,
+    # so memory use doesn't grow with the number of files
+    queue_size = queue_size or thread_count
+    max_files_in_progress = len(stages) * (thread_count + queue_size)
+    files_in_progress = threading.Semaphore(max_files_in_progress)
+    cancelled = threading.Event()
+    stdout = ThreadOutput(sys.stdout)
+    stderr = ThreadOutput(sys.stderr)
+
+    input_queue = Queue(queue_size)
+    queues = [input_queue] + [Queue(queue_size) for _ in stages[1:]]
+    # The results are taken off the last queue as soon as they are done,
+    # and the number of files in progress already bounds its size
+    queues.append(Queue())
+    # The first stage unpacks the paths
+    stage_functions = [lambda path_tuple: stages[0](*path_tuple)] + list(stages[1:])
+    pipeline_stages = [
+        PipelineStage(
+            function,
+            thread_count,
+            queues[index],
+            queues[index + 1],
+            thread_count if index + 1 < len(stages) else 1,
+            stdout,
+            stderr,
+            cancelled,
+        )
+        for index, function in enumerate(stage_functions)
+    ]
+
+    def feed_files():
+        for index, path_tuple in enumerate(path_tuples):
+            files_in_progress.acquire()
+            if cancelled.is_set():
+                break
+            input_queue.put(PipelineItem(index, path_tuple))
+        for _ in range(thread_count):
+            input_queue.put(end_of_files)
+
+    feeder = threading.Thread(target=feed_files, daemon=True)
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        for pipeline_stage in pipeline_stages:
+            pipeline_stage.start()
+        feeder.start()
+        try:
+            # Results can finish out of order, so they wait here
+            # until the results before them are done
+            finished_items = {}
+            for next_index in range(len(path_tuples)):
+                while next_index not in finished_items:
+                    item = queues[-1].get()
+                    finished_items[item.index] = item
+                item = finished_items.pop(next_index)
+                files_in_progress.release()
+                print(item.stdout.getvalue(), end="")
+                print(item.stderr.getvalue(), end="", file=sys.stderr)
+                if item.error is not None:
+                    raise item.error
+                yield item.result
+        finally:
+            # Files that haven't started are skipped, and the files
+            # being processed are finished before returning
+            cancelled.set()
+            for _ in range(max_files_in_progress):
+                files_in_progress.release()
+            feeder.join()
+            for pipeline_stage in pipeline_stages:
+                pipeline_stage.join()
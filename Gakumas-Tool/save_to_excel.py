@@ -1,6 +1,12 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from difflib import SequenceMatcher
 from name_dictionary import name_translation_dict
 from data_types import RawLine, TranslationLine
-from spreadsheet import get_tl_lines_from_spreadsheet, write_tl_lines_to_spreadsheet
+from instrumentation import FileStats, add_count, measure_stage
+from fingerprint import get_raw_lines_fingerprint, read_fingerprint, write_fingerprint
+from translation_memory import TranslationMemory
+from file_formats import get_file_format, get_tl_lines
 
 
 def to_raw_line(translation_line: TranslationLine):
@@ -27,37 +33,315 @@ def translate_name(name: str):
 
 
 def merge_lines(raw_lines: list[RawLine], existing_tl_lines: list[TranslationLine]):
-    new_tl_lines: list[TranslationLine] = []
     # We insert the existing translations if the original strings in
     # the type, name, text columns are all the same
+    # Existing rows are queued by their original strings, so if for some reason
+    # there are two different rows with the same original strings, the second one
+    # will be copied over the second time (instead of the first one being
+    # copied over every time)
+    existing_tl_line_queues: defaultdict[RawLine, deque[TranslationLine]] = defaultdict(
+        deque
+    )
+    for tl_line in existing_tl_lines:
+        existing_tl_line_queues[to_raw_line(tl_line)].append(tl_line)
+
+    new_tl_lines: list[TranslationLine] = []
     for raw_line in raw_lines:
-        try:
-            tl_line = next(
-                tl_line
-                for tl_line in existing_tl_lines
-                if to_raw_line(tl_line) == raw_line
-            )
-            # Remove the matching row we found
-            # This means that if for some reason there are two different rows
-            # with the same original strings, the second one will be copied over
-            # the second time (instead of the first one being copied over every time)
-            existing_tl_lines.remove(tl_line)
-        except StopIteration:  # if no matching row found
+        tl_line_queue = existing_tl_line_queues.get(raw_line)
+        if tl_line_queue:
+            tl_line = tl_line_queue.popleft()
+        else:  # if no matching row found
             tl_line = to_translation_line(raw_line)
         new_tl_lines.append(tl_line)
     return new_tl_lines
 
 
-def save_to_excel(
+# How similar the text of an edited row has to be to the text of an existing row
+# (as a difflib ratio) for the existing translation to be carried over
+similarity_threshold = 0.75
+# How many existing rows around the expected position are compared
+# with each edited row
+candidate_window = 8
+
+
+def is_similar_text(text: str, other_text: str):
+    text_matcher = SequenceMatcher(None, text, other_text, autojunk=False)
+    # The quick ratios are upper bounds of the ratio, so most rows
+    # can be ruled out without computing the actual ratio
+    return (
+        text_matcher.real_quick_ratio() >= similarity_threshold
+        and text_matcher.quick_ratio() >= similarity_threshold
+        and text_matcher.ratio() >= similarity_threshold
+    )
+
+
+def find_similar_rows(
+    old_raw_lines: list[RawLine], new_raw_lines: list[RawLine]
+) -> dict[int, int]:
+    # Pairs up the rows of a block of edited rows with existing rows that have
+    # the same type and name and similar text, and returns the index of
+    # the existing row for each paired new row
+    # Rows are only compared with rows with the same type and name, near where
+    # they would be if the rows of that type and name were spread out evenly,
+    # so each row is compared with a few rows instead of the whole block
+    old_indices_by_key: defaultdict[tuple, list[int]] = defaultdict(list)
+    new_indices_by_key: defaultdict[tuple, list[int]] = defaultdict(list)
+    for index, raw_line in enumerate(old_raw_lines):
+        old_indices_by_key[raw_line.group_type, raw_line.name].append(index)
+    for index, raw_line in enumerate(new_raw_lines):
+        new_indices_by_key[raw_line.group_type, raw_line.name].append(index)
+
+    similar_rows = {}
+    for key, new_indices in new_indices_by_key.items():
+        old_indices = old_indices_by_key.get(key)
+        if not old_indices:
+            continue
+        used_positions = set()
+        for new_position, new_index in enumerate(new_indices):
+            expected_position = new_position * len(old_indices) // len(new_indices)
+            start = max(0, expected_position - candidate_window)
+            end = min(len(old_indices), expected_position + candidate_window + 1)
+            # Closest rows first, so the nearest of equally similar rows is used
+            candidate_positions = sorted(
+                range(start, end),
+                key=lambda position: abs(position - expected_position),
+            )
+            for old_position in candidate_positions:
+                old_index = old_indices[old_position]
+                if old_position not in used_positions and is_similar_text(
+                    old_raw_lines[old_index].text, new_raw_lines[new_index].text
+                ):
+                    used_positions.add(old_position)
+                    similar_rows[new_index] = old_index
+                    break
+    return similar_rows
+
+
+def get_unique_anchors(
+    old_ids: list[int],
+    old_start: int,
+    old_end: int,
+    new_ids: list[int],
+    new_start: int,
+    new_end: int,
+) -> list[tuple[int, int]]:
+    # Returns the positions of the rows that appear exactly once in both ranges,
+    # keeping the longest run of them that is in the same order in both
+    old_counts = Counter(old_ids[old_start:old_end])
+    new_counts = Counter(new_ids[new_start:new_end])
+    old_positions = {
+        old_ids[index]: index
+        for index in range(old_start, old_end)
+        if old_counts[old_ids[index]] == 1
+    }
+    pairs = [
+        (old_positions[new_ids[index]], index)
+        for index in range(new_start, new_end)
+        if new_counts[new_ids[index]] == 1 and new_ids[index] in old_positions
+    ]
+    # The pairs are in the order of the new rows, so the longest run in order
+    # is the longest increasing subsequence of the old positions,
+    # found by patience sorting
+    pile_tops: list[int] = []
+    pile_top_indices: list[int] = []
+    previous_indices: list[int] = []
+    for pair_index, (old_index, _) in enumerate(pairs):
+        pile = bisect_left(pile_tops, old_index)
+        previous_indices.append(pile_top_indices[pile - 1] if pile > 0 else -1)
+        if pile == len(pile_tops):
+            pile_tops.append(old_index)
+            pile_top_indices.append(pair_index)
+        else:
+            pile_tops[pile] = old_index
+            pile_top_indices[pile] = pair_index
+    anchors = []
+    pair_index = pile_top_indices[-1] if pile_top_indices else -1
+    while pair_index >= 0:
+        anchors.append(pairs[pair_index])
+        pair_index = previous_indices[pair_index]
+    anchors.reverse()
+    return anchors
+
+
+def get_aligned_opcodes(
+    old_ids: list[int], new_ids: list[int]
+) -> list[tuple[str, int, int, int, int]]:
+    # Like SequenceMatcher.get_opcodes, but the rows that appear once in both
+    # versions are matched up first (as in patience diff), and the rows between
+    # them are aligned the same way, until there are no such rows left
+    # Only the rows left between them are compared with SequenceMatcher,
+    # which takes much longer than linear time on long files
+    opcodes = []
+    # Ranges still to be aligned, and opcodes of matched rows, in reverse order
+    stack: list[tuple[str, int, int, int, int]] = [
+        ("range", 0, len(old_ids), 0, len(new_ids))
+    ]
+    while stack:
+        tag, old_start, old_end, new_start, new_end = stack.pop()
+        if tag != "range":
+            opcodes.append((tag, old_start, old_end, new_start, new_end))
+            continue
+        if old_start == old_end and new_start == new_end:
+            continue
+        anchors = get_unique_anchors(
+            old_ids, old_start, old_end, new_ids, new_start, new_end
+        )
+        if not anchors:
+            sequence_matcher = SequenceMatcher(
+                None,
+                old_ids[old_start:old_end],
+                new_ids[new_start:new_end],
+                autojunk=False,
+            )
+            opcodes.extend(
+                (tag, i1 + old_start, i2 + old_start, j1 + new_start, j2 + new_start)
+                for tag, i1, i2, j1, j2 in sequence_matcher.get_opcodes()
+            )
+            continue
+        parts = []
+        for old_index, new_index in anchors:
+            parts.append(("range", old_start, old_index, new_start, new_index))
+            parts.append(("equal", old_index, old_index + 1, new_index, new_index + 1))
+            old_start, new_start = old_index + 1, new_index + 1
+        parts.append(("range", old_start, old_end, new_start, new_end))
+        stack.extend(reversed(parts))
+    return opcodes
+
+
+def align_merge_lines(
+    raw_lines: list[RawLine], existing_tl_lines: list[TranslationLine]
+) -> tuple[list[TranslationLine], set[int]]:
+    # Like merge_lines, but the existing rows are aligned with the new rows,
+    # so translations are also carried over to rows that were slightly edited
+    # Returns the merged rows, and the indices of the rows whose translations
+    # were carried over from an edited row and need to be reviewed
+    existing_raw_lines = [to_raw_line(tl_line) for tl_line in existing_tl_lines]
+    # The rows are aligned as ids, which are much faster to compare and hash
+    # than tuples of strings
+    row_ids: dict[RawLine, int] = {}
+    existing_row_ids = [
+        row_ids.setdefault(raw_line, len(row_ids)) for raw_line in existing_raw_lines
+    ]
+    new_row_ids = [row_ids.setdefault(raw_line, len(row_ids)) for raw_line in raw_lines]
+    new_tl_lines: list[TranslationLine | None] = [None] * len(raw_lines)
+    is_used = [False] * len(existing_tl_lines)
+    edited_blocks = []
+    for tag, i1, i2, j1, j2 in get_aligned_opcodes(existing_row_ids, new_row_ids):
+        if tag == "equal":
+            new_tl_lines[j1:j2] = existing_tl_lines[i1:i2]
+            is_used[i1:i2] = [True] * (i2 - i1)
+        else:
+            edited_blocks.append((i1, i2, j1, j2))
+
+    # Rows that moved are carried over as they are
+    unused_tl_line_queues: defaultdict[RawLine, deque[int]] = defaultdict(deque)
+    for index, raw_line in enumerate(existing_raw_lines):
+        if not is_used[index]:
+            unused_tl_line_queues[raw_line].append(index)
+    for index, raw_line in enumerate(raw_lines):
+        if new_tl_lines[index] is None:
+            index_queue = unused_tl_line_queues.get(raw_line)
+            if index_queue:
+                existing_index = index_queue.popleft()
+                new_tl_lines[index] = existing_tl_lines[existing_index]
+                is_used[existing_index] = True
+
+    # The remaining rows of each edited block are paired with
+    # similar rows from the existing rows they replaced
+    # Existing rows without a translation have nothing to carry over,
+    # so they aren't paired, and the new rows are left untranslated
+    review_rows = set()
+    for i1, i2, j1, j2 in edited_blocks:
+        old_indices = [
+            index
+            for index in range(i1, i2)
+            if not is_used[index]
+            and (
+                existing_tl_lines[index].translated_text != ""
+                or existing_tl_lines[index].translated_name != ""
+            )
+        ]
+        new_indices = [index for index in range(j1, j2) if new_tl_lines[index] is None]
+        if not old_indices or not new_indices:
+            continue
+        similar_rows = find_similar_rows(
+            [existing_raw_lines[index] for index in old_indices],
+            [raw_lines[index] for index in new_indices],
+        )
+        for new_position, old_position in similar_rows.items():
+            index = new_indices[new_position]
+            # Keep the new original strings, and carry over the translations
+            new_tl_lines[index] = existing_tl_lines[old_indices[old_position]]._replace(
+                text=raw_lines[index].text
+            )
+            review_rows.add(index)
+
+    merged_tl_lines = [
+        tl_line if tl_line is not None else to_translation_line(raw_line)
+        for tl_line, raw_line in zip(new_tl_lines, raw_lines)
+    ]
+    return merged_tl_lines, review_rows
+
+
+def fill_from_memory(tl_lines: list[TranslationLine], memory: TranslationMemory):
+    # Fills in the untranslated rows with translations of the same lines
+    # from the translation memory, looking up all of the rows at once
+    untranslated_raw_lines = [
+        to_raw_line(tl_line) for tl_line in tl_lines if tl_line.translated_text == ""
+    ]
+    if not untranslated_raw_lines:
+        return tl_lines
+    remembered_translations = memory.look_up(untranslated_raw_lines)
+    filled_tl_lines = []
+    for tl_line in tl_lines:
+        remembered_translation = (
+            remembered_translations.get(to_raw_line(tl_line))
+            if tl_line.translated_text == ""
+            else None
+        )
+        if remembered_translation is not None:
+            translated_name, translated_text = remembered_translation
+            tl_line = tl_line._replace(
+                translated_name=tl_line.translated_name or translated_name,
+                translated_text=translated_text,
+            )
+        filled_tl_lines.append(tl_line)
+    return filled_tl_lines
+
+
+def merge_with_spreadsheet(
     raw_lines: list[RawLine],
     output_path: str,
     worksheet_name: str,
     force_overwrite: bool,
-):
-    try:
-        existing_tl_lines = get_tl_lines_from_spreadsheet(output_path, worksheet_name)
-    except FileNotFoundError:
-        existing_tl_lines = []
+    align: bool = False,
+    memory: TranslationMemory | None = None,
+    stats: FileStats | None = None,
+    format_name: str = "xlsx",
+) -> tuple[list[TranslationLine], set[int], str] | None:
+    # Reads the existing spreadsheet (or file of the given format)
+    # and merges its translations into the lines
+    # Returns the merged lines, the rows to highlight for review and the
+    # fingerprint of the raw lines, or None if the spreadsheet is unchanged
+    add_count(stats, "rows", len(raw_lines))
+    # Skip the spreadsheet without loading it if its raw data is known
+    # to be the same, from the fingerprint written when it was last checked
+    with measure_stage(stats, "fingerprint"):
+        fingerprint = get_raw_lines_fingerprint(raw_lines)
+        is_fingerprint_unchanged = read_fingerprint(output_path) == fingerprint
+    if not force_overwrite and is_fingerprint_unchanged:
+        print(f"No change in raw lines in {output_path}, skipping...")
+        return None
+
+    with measure_stage(stats, "read spreadsheet"):
+        try:
+            existing_tl_lines = get_tl_lines(output_path, worksheet_name, format_name)
+        except FileNotFoundError:
+            existing_tl_lines = []
+    # The spreadsheet has been read anyway, so remember its translations
+    if memory is not None:
+        with measure_stage(stats, "translation memory"):
+            memory.add_tl_lines(existing_tl_lines)
 
     # Don't do anything if the raw data from the commu files
     # is the same as the raw data from the existing spreadsheet
@@ -65,8 +349,60 @@ def save_to_excel(
     existing_raw_lines = [to_raw_line(tl_line) for tl_line in existing_tl_lines]
     if not force_overwrite and raw_lines == existing_raw_lines:
         print(f"No change in raw lines in {output_path}, skipping...")
-        return
+        write_fingerprint(output_path, fingerprint)
+        return None
+
+    with measure_stage(stats, "merge"):
+        if align:
+            merged_tl_lines, review_rows = align_merge_lines(
+                raw_lines, existing_tl_lines
+            )
+        else:
+            merged_tl_lines = merge_lines(raw_lines, existing_tl_lines)
+            review_rows = set()
+    if memory is not None:
+        with measure_stage(stats, "translation memory"):
+            merged_tl_lines = fill_from_memory(merged_tl_lines, memory)
+    return merged_tl_lines, review_rows, fingerprint
 
-    merged_tl_lines = merge_lines(raw_lines, existing_tl_lines)
-    write_tl_lines_to_spreadsheet(merged_tl_lines, output_path, worksheet_name)
+
+def write_merged_spreadsheet(
+    merged: tuple[list[TranslationLine], set[int], str],
+    output_path: str,
+    worksheet_name: str,
+    stats: FileStats | None = None,
+    format_name: str = "xlsx",
+):
+    merged_tl_lines, review_rows, fingerprint = merged
+    with measure_stage(stats, "write spreadsheet"):
+        get_file_format(format_name).write_tl_lines(
+            merged_tl_lines, output_path, worksheet_name, review_rows
+        )
+        write_fingerprint(output_path, fingerprint)
     print(f"Conversion completed for {output_path}")
+
+
+def save_to_excel(
+    raw_lines: list[RawLine],
+    output_path: str,
+    worksheet_name: str,
+    force_overwrite: bool,
+    align: bool = False,
+    memory: TranslationMemory | None = None,
+    stats: FileStats | None = None,
+    format_name: str = "xlsx",
+):
+    merged = merge_with_spreadsheet(
+        raw_lines,
+        output_path,
+        worksheet_name,
+        force_overwrite,
+        align,
+        memory,
+        stats,
+        format_name,
+    )
+    if merged is not None:
+        write_merged_spreadsheet(
+            merged, output_path, worksheet_name, stats, format_name
+        )
@@ -1,9 +1,16 @@
-import openpyxl
-import openpyxl.styles
+import itertools
 import os
+import zipfile
+from typing import Iterator
 from data_types import TranslationLine
+from xlsx_codec import UnsupportedSpreadsheet, iter_xlsx_rows, write_xlsx
 
 column_headers = ("type", "name", "translated name", "text", "translated text")
+# "native" reads and writes the XLSX files directly, and "openpyxl" goes
+# through openpyxl, which the native codec also falls back on when reading
+# spreadsheets it doesn't support
+spreadsheet_codecs = ("native", "openpyxl")
+# openpyxl takes a while to import, so it's only imported when it's used
 
 
 def convert_to_string(data):
@@ -21,21 +28,14 @@ def is_blank(row: tuple):
     return all(item is None for item in row)
 
 
-def get_tl_lines_from_spreadsheet(
-    spreadsheet_path: str, worksheet_name: str
-) -> list[TranslationLine]:
-    # Read data from workbook
-    workbook = openpyxl.load_workbook(filename=spreadsheet_path)
-    existing_rows = [
-        row
-        for row in workbook[worksheet_name].iter_rows(
-            min_col=1, max_col=5, values_only=True
-        )
-        if not is_blank(row)
-    ]
+def iter_tl_lines_from_rows(rows: Iterator[tuple]) -> Iterator[TranslationLine]:
+    existing_rows = (row for row in rows if not is_blank(row))
 
     # check it has the right column headers
-    existing_column_headers = tuple(str(header) for header in existing_rows[0])
+    header_row = next(existing_rows, None)
+    if header_row is None:
+        raise Exception("Existing spreadsheet has no column headers!")
+    existing_column_headers = tuple(str(header) for header in header_row)
     if existing_column_headers != column_headers:
         raise Exception(
             f"Existing spreadsheet has incorrect column headers!"
@@ -43,42 +43,62 @@ def get_tl_lines_from_spreadsheet(
             + f"but spreadsheet has headers\n{",".join(existing_column_headers)}"
         )
 
-    return [row_to_translation_line(data_row) for data_row in existing_rows[1:]]
+    for data_row in existing_rows:
+        yield row_to_translation_line(data_row)
 
 
-def write_tl_lines_to_spreadsheet(
-    tl_lines: list[TranslationLine], output_path: str, worksheet_name: str
-):
-    # Create the spreadsheet
-    workbook = openpyxl.Workbook()
-    worksheet = workbook.active
-    if not worksheet:
-        raise Exception("Workbook has no active worksheet!")
-    worksheet.title = worksheet_name
-
-    # Write data to the worksheet
-    worksheet.append(column_headers)
-    for index, tl_line in enumerate(tl_lines):
-        worksheet.append(tl_line)
-        # Adjust row heights automatically based on the content
-        text_line_count = tl_line.text.count("\n") + 1
-        translated_text_line_count = tl_line.translated_text.count("\n") + 1
-        row_height = 15 * max(  # Assuming default row height is 15 units
-            text_line_count, translated_text_line_count
+def iter_tl_lines_with_openpyxl(
+    spreadsheet_path: str, worksheet_name: str
+) -> Iterator[TranslationLine]:
+    # Read data from workbook one row at a time,
+    # without loading every cell and style of the workbook first
+    # The workbook is closed once all rows are read or the iterator is closed
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(filename=spreadsheet_path, read_only=True)
+    try:
+        yield from iter_tl_lines_from_rows(
+            workbook[worksheet_name].iter_rows(min_col=1, max_col=5, values_only=True)
         )
-        worksheet.row_dimensions[index + 2].height = row_height
+    finally:
+        workbook.close()
+
+
+def iter_tl_lines_from_spreadsheet(
+    spreadsheet_path: str, worksheet_name: str, codec: str = "native"
+) -> Iterator[TranslationLine]:
+    # With the native codec, spreadsheets it doesn't support are read with
+    # openpyxl instead, carrying on after the rows that were already read
+    if codec not in spreadsheet_codecs:
+        raise Exception(f"Unknown spreadsheet codec {codec}!")
+    read_line_count = 0
+    if codec == "native":
+        try:
+            for tl_line in iter_tl_lines_from_rows(
+                iter_xlsx_rows(spreadsheet_path, worksheet_name, len(column_headers))
+            ):
+                yield tl_line
+                read_line_count += 1
+            return
+        except (UnsupportedSpreadsheet, zipfile.BadZipFile):
+            pass
+    yield from itertools.islice(
+        iter_tl_lines_with_openpyxl(spreadsheet_path, worksheet_name),
+        read_line_count,
+        None,
+    )
 
-    # Set column widths
-    worksheet.column_dimensions["A"].width = 15  # type column
-    worksheet.column_dimensions["B"].width = 15  # name column
-    worksheet.column_dimensions["C"].width = 15  # translated name column
-    # Text columns have larger widths if it's a main story commu
-    if os.path.basename(output_path).startswith("adv_unit_"):
-        worksheet.column_dimensions["D"].width = 70  # text column
-        worksheet.column_dimensions["E"].width = 70  # translated column
-    else:
-        worksheet.column_dimensions["D"].width = 38  # text column
-        worksheet.column_dimensions["E"].width = 38  # translated column
+
+def get_tl_lines_from_spreadsheet(
+    spreadsheet_path: str, worksheet_name: str, codec: str = "native"
+) -> list[TranslationLine]:
+    return list(iter_tl_lines_from_spreadsheet(spreadsheet_path, worksheet_name, codec))
+
+
+def create_column_styles(is_for_review: bool = False):
+    # Returns the alignment and fill of each column, with a highlight
+    # if it's for rows whose translations were carried over from an edited line
+    import openpyxl.styles
 
     # Define formats for cell alignment and text wrapping
     dialogue_alignment = openpyxl.styles.Alignment(
@@ -91,13 +111,93 @@ def write_tl_lines_to_spreadsheet(
         # without text wrapping, which is preferrable
     )
     name_alignment = openpyxl.styles.Alignment(horizontal="center", vertical="center")
-    # Apply alignment formats
-    for row in worksheet["A:C"]:
-        for cell in row:
-            cell.alignment = name_alignment
-    for row in worksheet["D:E"]:
-        for cell in row:
-            cell.alignment = dialogue_alignment
+    fill = (
+        openpyxl.styles.PatternFill(fill_type="solid", fgColor="FFFF00")
+        if is_for_review
+        else None
+    )
+    return [(name_alignment, fill)] * 3 + [(dialogue_alignment, fill)] * 2
+
+
+def create_styled_row(worksheet, values, styles):
+    # The cells are styled before they are appended, so the worksheet
+    # doesn't need to be walked again to style every cell
+    from openpyxl.cell import WriteOnlyCell
+
+    row = []
+    for value, (alignment, fill) in zip(values, styles):
+        cell = WriteOnlyCell(worksheet, value=value)
+        cell.alignment = alignment
+        if fill is not None:
+            cell.fill = fill
+        row.append(cell)
+    return row
+
+
+def get_column_widths(output_path: str) -> list[int]:
+    # type, name and translated name columns
+    column_widths = [15, 15, 15]
+    # Text columns have larger widths if it's a main story commu
+    if os.path.basename(output_path).startswith("adv_unit_"):
+        column_widths += [70, 70]  # text and translated columns
+    else:
+        column_widths += [38, 38]  # text and translated columns
+    return column_widths
+
+
+def get_row_height(tl_line: TranslationLine) -> int:
+    # Adjust row heights automatically based on the content
+    text_line_count = tl_line.text.count("\n") + 1
+    translated_text_line_count = tl_line.translated_text.count("\n") + 1
+    return 15 * max(  # Assuming default row height is 15 units
+        text_line_count, translated_text_line_count
+    )
+
+
+def write_tl_lines_to_spreadsheet(
+    tl_lines: list[TranslationLine],
+    output_path: str,
+    worksheet_name: str,
+    review_rows: frozenset[int] | set[int] = frozenset(),
+    codec: str = "native",
+):
+    # review_rows are the indices in tl_lines of the rows to highlight for review
+    if codec not in spreadsheet_codecs:
+        raise Exception(f"Unknown spreadsheet codec {codec}!")
+    if codec == "native":
+        write_xlsx(
+            output_path,
+            worksheet_name,
+            column_headers,
+            (
+                (tl_line, get_row_height(tl_line), index in review_rows)
+                for index, tl_line in enumerate(tl_lines)
+            ),
+            get_column_widths(output_path),
+        )
+        return
+
+    # Create the spreadsheet
+    import openpyxl
+
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    if not worksheet:
+        raise Exception("Workbook has no active worksheet!")
+    worksheet.title = worksheet_name
+    column_styles = create_column_styles()
+    review_column_styles = create_column_styles(is_for_review=True)
+
+    # Write data to the worksheet
+    worksheet.append(create_styled_row(worksheet, column_headers, column_styles))
+    for index, tl_line in enumerate(tl_lines):
+        styles = review_column_styles if index in review_rows else column_styles
+        worksheet.append(create_styled_row(worksheet, tl_line, styles))
+        worksheet.row_dimensions[index + 2].height = get_row_height(tl_line)
+
+    # Set column widths
+    for column_letter, column_width in zip("ABCDE", get_column_widths(output_path)):
+        worksheet.column_dimensions[column_letter].width = column_width
 
     # Close the workbook to save the Excel file
     workbook.save(output_path)
@@ -0,0 +1,99 @@
+import json
+import os
+import sys
+from typing import NamedTuple
+from atomic_write import write_json_atomically
+from data_types import TranslationLine
+from file_formats import get_tl_lines
+from manifest import remove_missing_entries
+
+status_index_file_name = ".status-index.json"
+status_index_version = 1
+
+
+class TranslationCounts(NamedTuple):
+    translated_rows: int
+    untranslated_rows: int
+    # The characters in the original text of the rows
+    translated_chars: int
+    untranslated_chars: int
+
+
+def count_translations(tl_lines: list[TranslationLine]) -> TranslationCounts:
+    translated_rows = 0
+    untranslated_rows = 0
+    translated_chars = 0
+    untranslated_chars = 0
+    for tl_line in tl_lines:
+        if tl_line.translated_text != "":
+            translated_rows += 1
+            translated_chars += len(tl_line.text)
+        else:
+            untranslated_rows += 1
+            untranslated_chars += len(tl_line.text)
+    return TranslationCounts(
+        translated_rows, untranslated_rows, translated_chars, untranslated_chars
+    )
+
+
+def add_counts(counts: TranslationCounts, other_counts: TranslationCounts):
+    return TranslationCounts(*(a + b for a, b in zip(counts, other_counts)))
+
+
+class StatusIndex:
+    # Remembers the translation counts of each file in a directory,
+    # along with its size and modification time when it was counted,
+    # so only the files that changed since then are read again
+    directory: str
+    entries: dict[str, dict]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index_path = os.path.join(directory, status_index_file_name)
+        self.entries = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            if index.get("version") == status_index_version:
+                self.entries = index["files"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError, KeyError):
+            # A broken index is treated as missing, and replaced when saved
+            print(
+                f"Warning: ignoring unreadable status index {self.index_path}",
+                file=sys.stderr,
+            )
+
+    def get_counts(
+        self, file_path: str, format_name: str = "xlsx"
+    ) -> tuple[TranslationCounts, bool]:
+        # Returns the counts of the file, and whether it had to be read
+        file_name = os.path.basename(file_path)
+        entry = self.entries.get(file_name)
+        file_stat = os.stat(file_path)
+        if (
+            entry is not None
+            and entry["size"] == file_stat.st_size
+            and entry["mtime_ns"] == file_stat.st_mtime_ns
+        ):
+            return TranslationCounts(**entry["counts"]), False
+        counts = count_translations(get_tl_lines(file_path, "Sheet1", format_name))
+        self.entries[file_name] = {
+            "size": file_stat.st_size,
+            "mtime_ns": file_stat.st_mtime_ns,
+            "counts": counts._asdict(),
+        }
+        return counts, True
+
+    def remove_missing(self, file_paths: list[str]):
+        # Forgets the files that are no longer in the directory
+        remove_missing_entries(self.entries, file_paths)
+
+    def save(self):
+        write_json_atomically(
+            self.index_path,
+            {"version": status_index_version, "files": self.entries},
+            ensure_ascii=False,
+            sort_keys=True,
+        )
@@ -0,0 +1,68 @@
+import sqlite3
+from data_types import RawLine, TranslationLine
+
+# A translation memory keeps the translations of every line in the spreadsheets
+# it has seen, so lines that show up again in other commu files
+# (stock choices, greetings, narration) can be filled in automatically
+# It's an SQLite database, so several processes can use it at the same time
+
+
+class TranslationMemory:
+    def __init__(self, database_path: str):
+        # Waits for other processes writing to the database
+        # instead of failing straight away
+        self.connection = sqlite3.connect(database_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            + "group_type TEXT NOT NULL, "
+            + "name TEXT NOT NULL, "
+            + "text TEXT NOT NULL, "
+            + "translated_name TEXT NOT NULL, "
+            + "translated_text TEXT NOT NULL, "
+            + "PRIMARY KEY (group_type, name, text)"
+            + ") WITHOUT ROWID"
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def add_tl_lines(self, tl_lines: list[TranslationLine]):
+        # Remembers the translated lines, replacing older translations
+        # of the same lines
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO translations "
+                + "(group_type, name, translated_name, text, translated_text) "
+                + "VALUES (?, ?, ?, ?, ?) "
+                + "ON CONFLICT DO UPDATE SET "
+                + "translated_name = excluded.translated_name, "
+                + "translated_text = excluded.translated_text",
+                (tl_line for tl_line in tl_lines if tl_line.translated_text != ""),
+            )
+
+    def look_up(self, raw_lines: list[RawLine]) -> dict[RawLine, tuple[str, str]]:
+        # Returns the translated name and text of the lines that are
+        # in the memory
+        # The lines are looked up together with a join on a temporary table,
+        # instead of one query for each line
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS lookup_lines ("
+                + "group_type TEXT, name TEXT, text TEXT)"
+            )
+            self.connection.execute("DELETE FROM lookup_lines")
+            self.connection.executemany(
+                "INSERT INTO lookup_lines VALUES (?, ?, ?)", set(raw_lines)
+            )
+            rows = self.connection.execute(
+                "SELECT group_type, name, text, translated_name, translated_text "
+                + "FROM lookup_lines "
+                + "JOIN translations USING (group_type, name, text)"
+            ).fetchall()
+            self.connection.execute("DELETE FROM lookup_lines")
+        return {
+            RawLine(group_type, name, text): (translated_name, translated_text)
+            for group_type, name, text, translated_name, translated_text in rows
+        }
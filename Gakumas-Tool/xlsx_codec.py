@@ -0,0 +1,315 @@
+import re
+import zipfile
+from typing import Iterable, Iterator
+from xml.etree.ElementTree import iterparse
+from data_types import TranslationLine
+
+# Reads and writes the spreadsheets of this tool directly as XLSX zip files,
+# which is much faster than going through openpyxl's object model
+# Only the parts the translation sheets use are supported,
+# anything else raises UnsupportedSpreadsheet so openpyxl can be used instead
+
+main_namespace = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+relationships_namespace = (
+    "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+)
+package_relationships_namespace = (
+    "http://schemas.openxmlformats.org/package/2006/relationships"
+)
+
+cell_tag = f"{{{main_namespace}}}c"
+row_tag = f"{{{main_namespace}}}row"
+value_tag = f"{{{main_namespace}}}v"
+formula_tag = f"{{{main_namespace}}}f"
+inline_string_tag = f"{{{main_namespace}}}is"
+shared_string_tag = f"{{{main_namespace}}}si"
+text_tag = f"{{{main_namespace}}}t"
+rich_text_run_tag = f"{{{main_namespace}}}r"
+sheet_tag = f"{{{main_namespace}}}sheet"
+relationship_tag = f"{{{package_relationships_namespace}}}Relationship"
+relationship_id_attribute = f"{{{relationships_namespace}}}id"
+
+cell_reference_pattern = re.compile(r"([A-Z]+)(\d+)")
+# Characters that can't be written in XML, the same ones openpyxl refuses to write
+illegal_character_pattern = re.compile(r"[\000-\010]|[\013-\014]|[\016-\037]")
+
+
+class UnsupportedSpreadsheet(Exception):
+    pass
+
+
+def get_column_index(column_letters: str):
+    column_index = 0
+    for letter in column_letters:
+        column_index = column_index * 26 + ord(letter) - ord("A") + 1
+    return column_index
+
+
+def get_column_letter(column_index: int):
+    column_letters = ""
+    while column_index > 0:
+        column_index, remainder = divmod(column_index - 1, 26)
+        column_letters = chr(ord("A") + remainder) + column_letters
+    return column_letters
+
+
+def get_text_content(element) -> str:
+    # The text of a string item, without its phonetic runs (rPh)
+    snippets = []
+    for child in element:
+        if child.tag == text_tag:
+            snippets.append(child.text or "")
+        elif child.tag == rich_text_run_tag:
+            snippets.append(child.findtext(text_tag) or "")
+    return "".join(snippets)
+
+
+def get_worksheet_path(xlsx_file: zipfile.ZipFile, worksheet_name: str):
+    # Finds the sheet with the name in the workbook,
+    # and the part its relationship points to
+    relationship_id = None
+    for _, element in iterparse(xlsx_file.open("xl/workbook.xml")):
+        if element.tag == sheet_tag and element.get("name") == worksheet_name:
+            relationship_id = element.get(relationship_id_attribute)
+    if relationship_id is None:
+        raise UnsupportedSpreadsheet(f"No worksheet named {worksheet_name}")
+    for _, element in iterparse(xlsx_file.open("xl/_rels/workbook.xml.rels")):
+        if element.tag == relationship_tag and element.get("Id") == relationship_id:
+            target = element.get("Target")
+            # Targets are usually relative to xl/, but can also be absolute
+            return target[1:] if target.startswith("/") else "xl/" + target
+    raise UnsupportedSpreadsheet(f"No part for worksheet {worksheet_name}")
+
+
+def read_shared_strings(xlsx_file: zipfile.ZipFile) -> list[str]:
+    try:
+        shared_strings_file = xlsx_file.open("xl/sharedStrings.xml")
+    except KeyError:
+        return []
+    shared_strings = []
+    for _, element in iterparse(shared_strings_file):
+        if element.tag == shared_string_tag:
+            # openpyxl removes this escape of underscores, so we do too
+            shared_strings.append(get_text_content(element).replace("x005F_", ""))
+            element.clear()
+    return shared_strings
+
+
+def get_cell_value(cell, shared_strings: list[str]):
+    # Returns the value of a cell the same way openpyxl does,
+    # as long as it is a string or empty
+    if cell.find(formula_tag) is not None:
+        raise UnsupportedSpreadsheet(f"Cell {cell.get("r")} has a formula")
+    data_type = cell.get("t", "n")
+    if data_type == "inlineStr":
+        inline_string = cell.find(inline_string_tag)
+        return None if inline_string is None else get_text_content(inline_string)
+    value = cell.findtext(value_tag) or None
+    if value is None:
+        return None
+    if data_type == "s":
+        return shared_strings[int(value)]
+    if data_type == "str":
+        return value
+    # Numbers can be dates depending on their format, and booleans
+    # and errors are rare enough to leave to openpyxl
+    raise UnsupportedSpreadsheet(f"Cell {cell.get("r")} has data type {data_type}")
+
+
+def iter_xlsx_rows(
+    spreadsheet_path: str, worksheet_name: str, column_count: int
+) -> Iterator[tuple]:
+    # Yields the values of the first column_count columns of each row
+    # of the worksheet, parsing the sheet one row at a time
+    # Rows without any cells are skipped
+    with zipfile.ZipFile(spreadsheet_path) as xlsx_file:
+        worksheet_path = get_worksheet_path(xlsx_file, worksheet_name)
+        shared_strings = read_shared_strings(xlsx_file)
+        for _, element in iterparse(xlsx_file.open(worksheet_path)):
+            if element.tag != row_tag:
+                continue
+            values = [None] * column_count
+            column_index = 0
+            for cell in element.iter(cell_tag):
+                cell_reference = cell.get("r")
+                if cell_reference is None:
+                    column_index += 1
+                else:
+                    reference_match = cell_reference_pattern.fullmatch(cell_reference)
+                    if reference_match is None:
+                        raise UnsupportedSpreadsheet(
+                            f"Invalid cell reference {cell_reference}"
+                        )
+                    column_index = get_column_index(reference_match[1])
+                if column_index <= column_count:
+                    values[column_index - 1] = get_cell_value(cell, shared_strings)
+            element.clear()
+            yield tuple(values)
+
+
+def escape(text: str):
+    # xml.sax.saxutils has the same function, but importing it imports urllib
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def escape_cell_text(text: str):
+    if illegal_character_pattern.search(text):
+        raise Exception(f"Cannot write {text!r} to a spreadsheet!")
+    return escape(text)
+
+
+# Styles of the cells of the first three (name) columns and the last two
+# (dialogue) columns, the same as the openpyxl writer uses
+# The ids of the cell formats are
+# 0 default, 1 name, 2 dialogue, 3 name for review, 4 dialogue for review
+name_style_id = 1
+dialogue_style_id = 2
+review_style_offset = 2
+styles_xml = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="{main_namespace}">\
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/><family val="2"/></font></fonts>\
+<fills count="3"><fill><patternFill/></fill><fill><patternFill patternType="gray125"/></fill>\
+<fill><patternFill patternType="solid"><fgColor rgb="00FFFF00"/></patternFill></fill></fills>\
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>\
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>\
+<cellXfs count="5"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>\
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" applyAlignment="1" xfId="0">\
+<alignment horizontal="center" vertical="center"/></xf>\
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" applyAlignment="1" xfId="0">\
+<alignment horizontal="left" vertical="top"/></xf>\
+<xf numFmtId="0" fontId="0" fillId="2" borderId="0" applyFill="1" applyAlignment="1" xfId="0">\
+<alignment horizontal="center" vertical="center"/></xf>\
+<xf numFmtId="0" fontId="0" fillId="2" borderId="0" applyFill="1" applyAlignment="1" xfId="0">\
+<alignment horizontal="left" vertical="top"/></xf></cellXfs>\
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>\
+</styleSheet>"""
+
+content_types_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">\
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>\
+<Default Extension="xml" ContentType="application/xml"/>\
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>\
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>\
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>\
+<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>\
+</Types>"""
+
+package_relationships_xml = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="{package_relationships_namespace}">\
+<Relationship Id="rId1" Type="{relationships_namespace}/officeDocument" Target="xl/workbook.xml"/>\
+</Relationships>"""
+
+workbook_relationships_xml = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="{package_relationships_namespace}">\
+<Relationship Id="rId1" Type="{relationships_namespace}/worksheet" Target="worksheets/sheet1.xml"/>\
+<Relationship Id="rId2" Type="{relationships_namespace}/styles" Target="styles.xml"/>\
+<Relationship Id="rId3" Type="{relationships_namespace}/sharedStrings" Target="sharedStrings.xml"/>\
+</Relationships>"""
+
+
+def create_workbook_xml(worksheet_name: str):
+    return f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="{main_namespace}" xmlns:r="{relationships_namespace}">\
+<bookViews><workbookView activeTab="0"/></bookViews>\
+<sheets><sheet name="{escape(worksheet_name).replace('"', "&quot;")}" sheetId="1" r:id="rId1"/></sheets>\
+</workbook>"""
+
+
+def write_xlsx(
+    output_path: str,
+    worksheet_name: str,
+    column_headers: tuple[str, ...],
+    rows: Iterable[tuple[TranslationLine, float, bool]],
+    column_widths: list[float],
+):
+    # Writes the header and the rows (each with its height, and whether
+    # it is highlighted for review) to a workbook with a single worksheet
+    # Strings are shared, since the types and names repeat on most rows
+    shared_string_ids: dict[str, int] = {}
+    shared_string_reference_count = 0
+    column_letters = [
+        get_column_letter(column_index + 1)
+        for column_index in range(len(column_headers))
+    ]
+    column_style_ids = [
+        name_style_id if column_index < 3 else dialogue_style_id
+        for column_index in range(len(column_headers))
+    ]
+
+    def create_row_xml(row_number: int, values, height, is_for_review: bool):
+        nonlocal shared_string_reference_count
+        style_offset = review_style_offset if is_for_review else 0
+        height_attributes = (
+            "" if height is None else f' ht="{height:g}" customHeight="1"'
+        )
+        cells = []
+        for column_letter, style_id, value in zip(
+            column_letters, column_style_ids, values
+        ):
+            reference = f"{column_letter}{row_number}"
+            style_id += style_offset
+            if value == "":
+                # Empty cells keep their style, so they look the same
+                cells.append(f'<c r="{reference}" s="{style_id}"/>')
+                continue
+            string_id = shared_string_ids.setdefault(value, len(shared_string_ids))
+            shared_string_reference_count += 1
+            cells.append(
+                f'<c r="{reference}" s="{style_id}" t="s"><v>{string_id}</v></c>'
+            )
+        return f'<row r="{row_number}"{height_attributes}>{"".join(cells)}</row>'
+
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as xlsx_file:
+        xlsx_file.writestr("[Content_Types].xml", content_types_xml)
+        xlsx_file.writestr("_rels/.rels", package_relationships_xml)
+        xlsx_file.writestr("xl/workbook.xml", create_workbook_xml(worksheet_name))
+        xlsx_file.writestr("xl/_rels/workbook.xml.rels", workbook_relationships_xml)
+        xlsx_file.writestr("xl/styles.xml", styles_xml)
+
+        # The rows are written to the sheet as they come,
+        # and only the shared strings are kept until the end
+        with xlsx_file.open("xl/worksheets/sheet1.xml", "w") as sheet_file:
+            columns = "".join(
+                f'<col min="{index}" max="{index}" width="{width:g}" customWidth="1"/>'
+                for index, width in enumerate(column_widths, 1)
+            )
+            sheet_file.write(f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="{main_namespace}" xmlns:r="{relationships_namespace}">\
+<sheetViews><sheetView workbookViewId="0"><selection activeCell="A1" sqref="A1"/>\
+</sheetView></sheetViews><sheetFormatPr baseColWidth="8" defaultRowHeight="15"/>\
+<cols>{columns}</cols><sheetData>""".encode("utf-8"))
+            sheet_file.write(
+                create_row_xml(
+                    1,
+                    [escape_cell_text(header) for header in column_headers],
+                    None,
+                    False,
+                ).encode("utf-8")
+            )
+            row_xmls = []
+            for row_number, (tl_line, height, is_for_review) in enumerate(rows, 2):
+                values = [escape_cell_text(value) for value in tl_line]
+                row_xmls.append(
+                    create_row_xml(row_number, values, height, is_for_review)
+                )
+                if len(row_xmls) >= 1000:
+                    sheet_file.write("".join(row_xmls).encode("utf-8"))
+                    row_xmls.clear()
+            sheet_file.write("".join(row_xmls).encode("utf-8"))
+            sheet_file.write(
+                b'</sheetData><pageMargins left="0.75" right="0.75" top="1" bottom="1"'
+                + b' header="0.5" footer="0.5"/></worksheet>'
+            )
+
+        # Shared strings with leading or trailing spaces (or only spaces)
+        # need xml:space="preserve", so it's used for all of them
+        shared_strings_xml = "".join(
+            f'<si><t xml:space="preserve">{shared_string}</t></si>'
+            for shared_string in shared_string_ids
+        )
+        xlsx_file.writestr(
+            "xl/sharedStrings.xml",
+            f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<sst xmlns="{main_namespace}" count="{shared_string_reference_count}" \
+uniqueCount="{len(shared_string_ids)}">{shared_strings_xml}</sst>""",
+        )